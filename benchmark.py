@@ -0,0 +1,375 @@
+"""離線性能測試：在本地啟動模擬 CDN 和作品列表接口，測量下載器各個路徑的吞吐量、延遲和內存
+
+用法示例：
+    python benchmark.py --files 20 --size 8 --workers 4
+    python benchmark.py --latency 50 --bandwidth 5 --fail-rate 0.05 --json result.json
+
+不需要瀏覽器或訪問抖音，修改下載路徑前後各運行一次並比較結果即可發現性能回退。
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from douyin_downloader import iter_post_api, setup_logging
+from douyin_downloader_copy import DouyinVideoDownloader
+
+# 模擬視頻的內容按這個塊重複，任何偏移的字節都可以直接算出來，不需要真的保存文件
+PATTERN = bytes(range(256)) * 256
+SEND_CHUNK = 64 * 1024
+
+# 關閉速率限制時使用的設置
+UNLIMITED_RATE_LIMITS = {
+    'global_rate': 1e6,
+    'host_rate': 1e6,
+    'host_max_rate': 1e6,
+    'host_burst': 1e6,
+}
+
+
+class BenchHandler(BaseHTTPRequestHandler):
+    """模擬 CDN（/video/<n>.mp4）和作品列表接口（/aweme/v1/web/aweme/post/）"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def do_GET(self):
+        if self.config['latency']:
+            time.sleep(self.config['latency'])
+        path = urlparse(self.path).path
+        if path.startswith('/aweme/v1/web/aweme/post'):
+            self.send_post_page()
+        elif re.match(r'/video/\d+\.mp4$', path):
+            self.send_video()
+        else:
+            self.send_empty(404)
+
+    def send_empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_post_page(self):
+        """按 max_cursor 分頁返回 aweme_list，播放地址指向本服務器"""
+        query = parse_qs(urlparse(self.path).query)
+        cursor = int(query.get('max_cursor', ['0'])[0])
+        page_size = self.config['page_size']
+        total = self.config['files']
+        base = f"http://{self.headers.get('Host')}"
+        aweme_list = [fixture_aweme(i, base) for i in range(cursor, min(cursor + page_size, total))]
+        body = json.dumps({
+            'aweme_list': aweme_list,
+            'max_cursor': cursor + len(aweme_list),
+            'has_more': 1 if cursor + page_size < total else 0,
+            'status_code': 0,
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_video(self):
+        """返回合成的 mp4 內容，按配置支持 Range、限速和隨機失敗"""
+        if random.random() < self.config['fail_rate']:
+            self.send_empty(503)
+            return
+
+        size = self.config['size']
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+        if match and self.config['range']:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.send_header('Accept-Ranges', 'bytes')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('ETag', f'"bench-{size}"')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        drop_at = None
+        if random.random() < self.config['drop_rate']:
+            drop_at = random.randint(start, end)
+
+        bandwidth = self.config['bandwidth']
+        sent_start = time.monotonic()
+        offset = start
+        try:
+            while offset <= end:
+                length = min(SEND_CHUNK, end - offset + 1)
+                if drop_at is not None and offset + length > drop_at:
+                    # 模擬連接中途斷開
+                    self.close_connection = True
+                    return
+                block_start = offset % len(PATTERN)
+                chunk = (PATTERN[block_start:] + PATTERN)[:length]
+                self.wfile.write(chunk)
+                offset += length
+                if bandwidth:
+                    ahead = (offset - start) / bandwidth - (time.monotonic() - sent_start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+def fixture_aweme(index, base):
+    """生成一個 aweme_list 項目，字段與作品列表接口一致（只包含下載器用到的部分）"""
+    return {
+        'aweme_id': str(7000000000000000000 + index),
+        'desc': f'bench video {index}',
+        'create_time': 1700000000 + index,
+        'author': {'sec_uid': 'BENCH_USER'},
+        'video': {
+            'play_addr': {'url_list': [f'{base}/video/{index}.mp4']},
+            'bit_rate': [],
+        },
+    }
+
+
+def serve(config, port_queue):
+    """在子進程中運行模擬服務器，避免服務器佔用的 CPU 和內存計入下載器"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BenchHandler)
+    server.daemon_threads = True
+    server.config = config
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def current_rss():
+    """返回當前進程的常駐內存（字節）"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # 沒有 /proc 時退回進程生命週期內的峰值（Linux 上單位為 KB）
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler:
+    """在後台定期採樣 RSS，記錄測試期間的峰值"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def percentile(values, p):
+    """返回 values 的第 p 百分位數（最近秩法），values 為空時返回 0"""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def timed(latencies, func):
+    """包裝 func，把每次調用的耗時追加到 latencies"""
+    lock = threading.Lock()
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+    return wrapper
+
+
+def folder_bytes(folder):
+    """下載資料夾中已完成的視頻總大小"""
+    return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder) if name.endswith('.mp4'))
+
+
+def make_downloader(args, folder):
+    """創建指向臨時資料夾的下載器，不載入 cookies"""
+    return DouyinVideoDownloader(
+        download_folder=folder,
+        cookies_file=os.path.join(folder, 'no-cookies.json'),
+        max_workers=args.workers,
+        per_host_limit=args.per_host,
+        segments=args.segments,
+        rate_limits=UNLIMITED_RATE_LIMITS if args.no_rate_limit else None,
+    )
+
+
+def run_scenario(name, args, base_url, body):
+    """在新的臨時資料夾中運行一個場景，body(downloader, latencies, base_url, args) 返回處理的項目數"""
+    folder = tempfile.mkdtemp(prefix='douyin-bench-')
+    latencies = []
+    output = io.StringIO()
+    # 下載器的日誌和進度寫入 output，--verbose 時在場景結束後輸出
+    setup_logging(stream=output)
+    try:
+        with contextlib.redirect_stdout(output):
+            downloader = make_downloader(args, folder)
+        try:
+            with RssSampler() as rss, contextlib.redirect_stdout(output):
+                start = time.perf_counter()
+                items = body(downloader, latencies, base_url, args)
+                elapsed = time.perf_counter() - start
+        finally:
+            with contextlib.redirect_stdout(output):
+                downloader.close()
+        size = folder_bytes(folder)
+        return {
+            'scenario': name,
+            'items': items,
+            'completed': len([n for n in os.listdir(folder) if n.endswith('.mp4')]),
+            'bytes': size,
+            'seconds': elapsed,
+            'throughput_mb_s': size / elapsed / 1e6 if elapsed and size else 0,
+            'p50_s': percentile(latencies, 50),
+            'p95_s': percentile(latencies, 95),
+            'peak_rss_mb': rss.peak / 1e6,
+        }
+    finally:
+        if args.verbose:
+            print(output.getvalue())
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def fetch_pages(downloader, base_url, page_size):
+    """用 iter_post_api 沿 max_cursor 取回所有模擬的作品列表頁面"""
+    return list(iter_post_api(downloader.fetch_post_page, 'BENCH_USER', page_size=page_size,
+                              api_url=f'{base_url}/aweme/v1/web/aweme/post/'))
+
+
+def scenario_fetch_video_list(downloader, latencies, base_url, args):
+    downloader.fetch_post_page = timed(latencies, downloader.fetch_post_page)
+    return len(fetch_pages(downloader, base_url, args.page_size))
+
+
+def scenario_process_video_list(downloader, latencies, base_url, args):
+    aweme_list = [fixture_aweme(i, base_url) for i in range(args.files)]
+    downloader.download_video = timed(latencies, downloader.download_video)
+    downloader.process_video_list(aweme_list)
+    return len(aweme_list)
+
+
+def scenario_download_video(downloader, latencies, base_url, args):
+    download_video = timed(latencies, downloader.download_video)
+    for i in range(args.files):
+        download_video(f'{base_url}/video/{i}.mp4', f'{i}.mp4')
+    return args.files
+
+
+def scenario_download_videos_from_urls(downloader, latencies, base_url, args):
+    video_info_list = [{
+        'index': i + 1,
+        'title': f'bench video {i}',
+        'url': f'{base_url}/video/{i}.mp4',
+        'aweme_id': str(7000000000000000000 + i),
+    } for i in range(args.files)]
+    downloader.download_from_video_info = timed(latencies, downloader.download_from_video_info)
+    downloader.download_videos_from_urls(video_info_list)
+    return len(video_info_list)
+
+
+SCENARIOS = {
+    'fetch_video_list': scenario_fetch_video_list,
+    'process_video_list': scenario_process_video_list,
+    'download_video': scenario_download_video,
+    'download_videos_from_urls': scenario_download_videos_from_urls,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='抖音下載器離線性能測試')
+    parser.add_argument('--files', type=int, default=20, help='模擬的視頻數量')
+    parser.add_argument('--size', type=float, default=4, help='每個視頻的大小（MB）')
+    parser.add_argument('--latency', type=float, default=0, help='服務器每個請求的延遲（毫秒）')
+    parser.add_argument('--bandwidth', type=float, default=0, help='每個連接的帶寬上限（MB/s），0 為不限')
+    parser.add_argument('--no-range', action='store_true', help='服務器不支持 Range 請求')
+    parser.add_argument('--fail-rate', type=float, default=0, help='視頻請求返回 503 的概率')
+    parser.add_argument('--drop-rate', type=float, default=0, help='視頻傳輸中途斷開的概率')
+    parser.add_argument('--page-size', type=int, default=18, help='作品列表每頁的項目數')
+    parser.add_argument('--workers', type=int, default=4, help='下載器的 max_workers')
+    parser.add_argument('--per-host', type=int, default=4, help='下載器的 per_host_limit')
+    parser.add_argument('--segments', type=int, default=1, help='下載器的 segments')
+    parser.add_argument('--no-rate-limit', action='store_true', help='關閉下載器的請求速率限制')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='要運行的場景，以逗號分隔')
+    parser.add_argument('--seed', type=int, default=0, help='隨機失敗使用的種子')
+    parser.add_argument('--json', help='把結果寫入 JSON 文件')
+    parser.add_argument('--verbose', action='store_true', help='顯示下載器的輸出')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    config = {
+        'files': args.files,
+        'size': int(args.size * 1024 * 1024),
+        'latency': args.latency / 1000,
+        'bandwidth': args.bandwidth * 1e6,
+        'range': not args.no_range,
+        'fail_rate': args.fail_rate,
+        'drop_rate': args.drop_rate,
+        'page_size': args.page_size,
+    }
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(config, port_queue), daemon=True)
+    server.start()
+    base_url = f'http://127.0.0.1:{port_queue.get(timeout=10)}'
+
+    results = []
+    try:
+        print(f"{'場景':<28}{'項目':>6}{'完成':>6}{'MB':>9}{'秒':>8}{'MB/s':>9}{'p50(s)':>9}{'p95(s)':>9}{'RSS(MB)':>9}")
+        for name in args.scenarios.split(','):
+            result = run_scenario(name, args, base_url, SCENARIOS[name])
+            results.append(result)
+            print(f"{name:<28}{result['items']:>6}{result['completed']:>6}{result['bytes'] / 1e6:>9.1f}{result['seconds']:>8.2f}"
+                  f"{result['throughput_mb_s']:>9.1f}{result['p50_s']:>9.3f}{result['p95_s']:>9.3f}"
+                  f"{result['peak_rss_mb']:>9.1f}")
+    finally:
+        server.terminate()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'config': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"結果已保存到: {args.json}")
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,159 @@
+"""常駐的 Chrome 瀏覽器，多個下載器進程通過 CDP 連接共用，不必每個進程各自啟動一次
+
+用法示例：
+    python -m browser_daemon --port 9222 --profile-template ~/.cache/douyin-profile
+    python -m douyin_cli --browser 127.0.0.1:9222 discover "https://www.douyin.com/user/..."
+
+啟動 Chrome 後定期請求 /json/version 做健康檢查，進程退出或連續多次沒有響應時按指數退避重新啟動。
+收到 SIGINT/SIGTERM 時關閉瀏覽器並清理臨時的用戶數據目錄。每個連接的下載器使用自己的瀏覽器上下文，
+cookies 由下載器在連接後寫入。
+"""
+import argparse
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+
+import requests
+
+from douyin_downloader import CHROME_ARGUMENTS, copy_profile, setup_logging
+
+logger = logging.getLogger(__name__)
+
+# 健康檢查的間隔（秒），連續 HEALTH_CHECK_FAILURES 次沒有響應時重啟瀏覽器
+HEALTH_CHECK_INTERVAL = 5
+HEALTH_CHECK_FAILURES = 3
+# 啟動後等待 remote debugging 端口可用的時間（秒）
+STARTUP_TIMEOUT = 30
+# 啟動失敗時重啟前的等待時間從 1 秒開始加倍，最多 RESTART_BACKOFF_MAX 秒；成功啟動過後重置
+RESTART_BACKOFF_MAX = 60
+
+
+def is_healthy(address, port, timeout=2):
+    """remote debugging 端口是否有響應，監聽所有地址（0.0.0.0）時通過本機回環地址檢查"""
+    host = '127.0.0.1' if address == '0.0.0.0' else address
+    try:
+        return requests.get(f'http://{host}:{port}/json/version', timeout=timeout).status_code == 200
+    except requests.RequestException:
+        return False
+
+
+class BrowserDaemon:
+    """啟動並監督一個開放 remote debugging 端口的 Chrome 進程"""
+
+    def __init__(self, chrome_path='/usr/bin/google-chrome', port=9222, address='127.0.0.1', profile_template=None):
+        self.chrome_path = chrome_path
+        self.port = port
+        self.address = address
+        self.profile_template = profile_template
+        self.process = None
+        self.user_data_dir = None
+        self._stop = threading.Event()
+
+    def command(self):
+        """Chrome 的命令行"""
+        return [
+            self.chrome_path,
+            *CHROME_ARGUMENTS,
+            f'--remote-debugging-address={self.address}',
+            f'--remote-debugging-port={self.port}',
+            '--remote-allow-origins=*',
+            f'--user-data-dir={self.user_data_dir}',
+            'about:blank',
+        ]
+
+    def start(self):
+        """啟動 Chrome 並等待端口可用，超時時拋出 RuntimeError"""
+        self.user_data_dir = tempfile.mkdtemp(prefix='douyin-chrome-')
+        if self.profile_template and os.path.isdir(self.profile_template):
+            copy_profile(self.profile_template, self.user_data_dir)
+        logger.info(f"正在啟動Chrome瀏覽器，端口: {self.port}")
+        self.process = subprocess.Popen(self.command(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for _ in range(STARTUP_TIMEOUT * 2):
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Chrome 啟動後立即退出，返回碼: {self.process.returncode}")
+            if is_healthy(self.address, self.port):
+                logger.info(f"瀏覽器已就緒: {self.address}:{self.port}")
+                return
+            if self._stop.wait(0.5):
+                return
+        raise RuntimeError(f"{STARTUP_TIMEOUT} 秒內沒有響應")
+
+    def stop(self):
+        """關閉 Chrome 並刪除臨時的用戶數據目錄"""
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+        if self.user_data_dir:
+            shutil.rmtree(self.user_data_dir, ignore_errors=True)
+            self.user_data_dir = None
+
+    def supervise(self):
+        """等待瀏覽器退出或失去響應，返回原因；收到停止信號時返回 None"""
+        failures = 0
+        while not self._stop.wait(HEALTH_CHECK_INTERVAL):
+            if self.process.poll() is not None:
+                return f"Chrome 已退出，返回碼: {self.process.returncode}"
+            if is_healthy(self.address, self.port):
+                failures = 0
+                continue
+            failures += 1
+            if failures >= HEALTH_CHECK_FAILURES:
+                return f"連續 {failures} 次健康檢查沒有響應"
+        return None
+
+    def run(self):
+        """啟動瀏覽器並一直監督，直到 shutdown() 被調用"""
+        backoff = 1
+        while not self._stop.is_set():
+            started = False
+            try:
+                self.start()
+                started = True
+                reason = self.supervise()
+            except (OSError, RuntimeError) as e:
+                reason = f"啟動瀏覽器失敗: {e}"
+            self.stop()
+            if self._stop.is_set():
+                break
+            # 已經正常運行過的瀏覽器崩潰後立即重啟，啟動失敗時才逐步延長等待
+            backoff = 1 if started else min(backoff * 2, RESTART_BACKOFF_MAX)
+            logger.warning(f"{reason}，{backoff} 秒後重新啟動")
+            self._stop.wait(backoff)
+
+    def shutdown(self, *args):
+        """停止監督並關閉瀏覽器，可以作為信號處理函數"""
+        self._stop.set()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='browser_daemon', description='啟動並監督供下載器共用的 Chrome 瀏覽器')
+    parser.add_argument('--chrome-path', default='/usr/bin/google-chrome', help='Chrome/Chromium 可執行文件')
+    parser.add_argument('--port', type=int, default=9222, help='remote debugging 端口')
+    parser.add_argument('--address', default='127.0.0.1',
+                        help='remote debugging 監聽的地址，其他容器需要連接時使用 0.0.0.0')
+    parser.add_argument('--profile-template', help='預熱的瀏覽器用戶數據目錄，每次啟動時複製')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging()
+    daemon = BrowserDaemon(args.chrome_path, args.port, args.address, args.profile_template)
+    signal.signal(signal.SIGINT, daemon.shutdown)
+    signal.signal(signal.SIGTERM, daemon.shutdown)
+    daemon.run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
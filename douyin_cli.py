@@ -0,0 +1,138 @@
+"""抖音下載器的命令行入口
+
+用法示例：
+    python -m douyin_cli discover "https://www.douyin.com/user/..." -o videos.json
+    python -m douyin_cli download videos.json --workers 8
+    python -m douyin_cli run "https://www.douyin.com/user/..." --incremental
+    python -m douyin_cli batch users.txt --report report.json
+    python -m douyin_cli --browser 127.0.0.1:9222 discover "https://www.douyin.com/user/..."
+
+download 只使用 HTTP，不需要安裝 Chrome 和 DrissionPage，只有鏈接過期、需要重新獲取地址時才會啟動瀏覽器。
+discover 和 batch 先直接分頁請求作品列表接口，接口不可用時才使用瀏覽器；run 需要瀏覽器。
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+
+from douyin_downloader import setup_logging
+from douyin_downloader_copy import DouyinVideoDownloader, VARIANT_POLICIES
+
+logger = logging.getLogger(__name__)
+
+
+def load_aweme_list(path):
+    """讀取 discover 保存的作品列表，也接受作品列表接口的原始響應（含 aweme_list 的對象）"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        return data.get('aweme_list') or []
+    return data
+
+
+def save_aweme_list(path, aweme_list):
+    """把作品列表寫入 path，先寫臨時文件再原子替換"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(aweme_list, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def make_downloader(args):
+    """按命令行參數創建下載器"""
+    return DouyinVideoDownloader(
+        download_folder=args.folder,
+        cookies_file=args.cookies,
+        max_workers=args.workers,
+        per_host_limit=args.per_host,
+        segments=args.segments,
+        variant_policy=args.variant,
+        metrics_jsonl=args.metrics_jsonl,
+        metrics_prom=args.metrics_prom,
+        profile_template=args.profile_template,
+        browser_address=args.browser,
+    )
+
+
+def cmd_discover(downloader, args):
+    """獲取用戶的作品列表並保存，不下載（緩存、作品列表接口，最後才用瀏覽器）"""
+    aweme_list = []
+    for user_url in args.user_urls:
+        aweme_list.extend(downloader.iter_user_aweme(user_url, incremental=args.incremental))
+    save_aweme_list(args.output, aweme_list)
+    logger.info(f"已保存 {len(aweme_list)} 個視頻到: {args.output}")
+
+
+def cmd_download(downloader, args):
+    """下載 discover 保存的作品列表"""
+    downloader.process_video_list(load_aweme_list(args.aweme_file))
+
+
+def cmd_run(downloader, args):
+    """獲取用戶的作品列表並下載"""
+    downloader.run(args.user_url, incremental=args.incremental)
+
+
+def cmd_batch(downloader, args):
+    """批量處理用戶列表文件中的所有用戶"""
+    downloader.run_batch(args.user_file, report_file=args.report, incremental=args.incremental)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='douyin_cli', description='下載抖音用戶的視頻')
+    parser.add_argument('--folder', default='douyin_videos', help='下載資料夾')
+    parser.add_argument('--cookies', default='cookies.json', help='cookies 文件（JSON 或 Netscape 格式）')
+    parser.add_argument('--workers', type=int, default=4, help='並行下載的線程數，1 為逐個下載')
+    parser.add_argument('--per-host', type=int, default=2, help='每個主機最多同時下載的視頻數')
+    parser.add_argument('--segments', type=int, default=1, help='單個視頻的分段並行下載數')
+    parser.add_argument('--variant', default='play_addr', choices=VARIANT_POLICIES, help='清晰度策略')
+    parser.add_argument('--metrics-jsonl', help='把各階段耗時和下載結果寫入 JSON lines 文件')
+    parser.add_argument('--metrics-prom', help='把匯總指標寫入 Prometheus textfile')
+    parser.add_argument('--profile-template', help='預熱的瀏覽器用戶數據目錄，不存在時在第一次運行後生成')
+    parser.add_argument('--browser', metavar='HOST:PORT', help='連接已在運行的瀏覽器（例如 browser_daemon），不自己啟動 Chrome')
+    parser.add_argument('-v', '--verbose', action='store_true', help='輸出調試日誌')
+    parser.add_argument('-q', '--quiet', action='store_true', help='只輸出警告和錯誤')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    discover = subparsers.add_parser('discover', help='獲取作品列表並保存為 JSON，不下載（接口不可用時使用瀏覽器）')
+    discover.add_argument('user_urls', nargs='+', help='用戶主頁 URL')
+    discover.add_argument('-o', '--output', default='aweme_list.json', help='保存作品列表的文件')
+    discover.add_argument('--incremental', action='store_true', help='只獲取上次同步之後的新視頻')
+    discover.set_defaults(func=cmd_discover)
+
+    download = subparsers.add_parser('download', help='下載 discover 保存的作品列表（不需要瀏覽器）')
+    download.add_argument('aweme_file', help='discover 保存的作品列表文件')
+    download.set_defaults(func=cmd_download)
+
+    run = subparsers.add_parser('run', help='獲取作品列表並下載（需要瀏覽器）')
+    run.add_argument('user_url', help='用戶主頁 URL')
+    run.add_argument('--incremental', action='store_true', help='只下載上次同步之後的新視頻')
+    run.set_defaults(func=cmd_run)
+
+    batch = subparsers.add_parser('batch', help='批量處理用戶列表文件（接口不可用時使用瀏覽器）')
+    batch.add_argument('user_file', help='每行一個用戶主頁 URL 的文件')
+    batch.add_argument('--report', help='結果報告文件，默認保存在下載資料夾中')
+    batch.add_argument('--incremental', action='store_true', help='只下載上次同步之後的新視頻')
+    batch.set_defaults(func=cmd_batch)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(logging.DEBUG if args.verbose else logging.WARNING if args.quiet else logging.INFO)
+    downloader = make_downloader(args)
+    try:
+        args.func(downloader, args)
+    except KeyboardInterrupt:
+        logger.warning("已中斷")
+        return 130
+    finally:
+        downloader.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
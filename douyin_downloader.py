@@ -1,151 +1,1823 @@
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
 import json
 import os
-from urllib.parse import urlparse
+from urllib.parse import urlparse, parse_qs, urlencode
 import time
-from DrissionPage import ChromiumPage, ChromiumOptions
 import re
 import tempfile
 import shutil
+import queue
+import sqlite3
+import hashlib
+import errno
+import threading
+import contextlib
+import logging
+import sys
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import MozillaCookieJar
+from typing import TYPE_CHECKING
 
-    
+# DrissionPage 只在需要瀏覽器時才導入（見 BrowserManager），只下載的進程不需要安裝它和 Chrome
+if TYPE_CHECKING:
+    from DrissionPage import ChromiumPage
+
+logger = logging.getLogger(__name__)
+
+# 共用 Session 每個主機的默認連接池大小，並行數更高時按並行數擴大
+DEFAULT_POOL_MAXSIZE = 10
+
+# 請求速率限制（每秒請求數），可通過 rate_limits 參數覆蓋。每個主機的速率按 AIMD 調整：
+# 成功後加 increase，429/5xx 後乘以 decrease，保持在 host_min_rate 和 host_max_rate 之間
+DEFAULT_RATE_LIMITS = {
+    'global_rate': 20,      # 所有主機合計的上限
+    'host_rate': 2,         # 每個主機的初始速率
+    'host_min_rate': 0.2,
+    'host_max_rate': 20,
+    'host_burst': 4,        # 每個主機空閒後最多可以連續發出的請求數
+    'increase': 0.2,
+    'decrease': 0.5,
+}
+
+# 下載視頻時在 Session 默認請求頭之上覆蓋的部分：CDN 不需要接口用的 Sec-Fetch-* 頭，
+# 並且要求不壓縮，保證寫入的字節數與 Content-Length 和 Range 偏移一致
+DOWNLOAD_HEADERS = {
+    'Accept': '*/*',
+    'Accept-Encoding': 'identity',
+    'Sec-Fetch-Dest': None,
+    'Sec-Fetch-Mode': None,
+    'Sec-Fetch-Site': None,
+}
+
+# 視頻請求的 (連接, 讀取) 超時（秒），卡住的鏡像會超時後切換到下一個
+DOWNLOAD_TIMEOUT = (10, 30)
+
+# url_list 中的鏡像：所有鏡像都失敗後最多重新嘗試的輪數，第 n 輪之前等待 MIRROR_BACKOFF * 2**(n-1) 秒
+MIRROR_RETRIES = 3
+MIRROR_BACKOFF = 1
+# 下載開始 SLOW_MIRROR_GRACE 秒後平均速度仍低於 SLOW_MIRROR_THROUGHPUT（字節/秒）時切換鏡像
+SLOW_MIRROR_THROUGHPUT = 100 * 1024
+SLOW_MIRROR_GRACE = 10
+# 失敗的主機在這段時間內排到最後（秒）
+MIRROR_FAILURE_TTL = 300
+
+# 分段下載時每段的最小大小，小於兩段的文件直接單線程下載
+SEGMENT_MIN_SIZE = 2 * 1024 * 1024
+
+# 用戶作品列表接口，返回 aweme_list、max_cursor 和 has_more
+POST_API_PATTERN = 'aweme/v1/web/aweme/post'
+# 作品列表接口只會以 XHR/Fetch 請求，監聽時排除其他資源類型
+POST_API_RES_TYPES = ('XHR', 'Fetch')
+# 不經過瀏覽器直接請求作品列表接口時使用的地址和固定參數（與網頁版發出的請求一致），每頁 POST_API_PAGE_SIZE 個
+POST_API_URL = 'https://www.douyin.com/aweme/v1/web/aweme/post/'
+POST_API_PAGE_SIZE = 18
+POST_API_PARAMS = {
+    'device_platform': 'webapp',
+    'aid': '6383',
+    'channel': 'channel_pc_web',
+    'publish_video_strategy_type': '2',
+    'pc_client_type': '1',
+    'version_code': '170400',
+    'version_name': '17.4.0',
+    'cookie_enabled': 'true',
+    'platform': 'PC',
+}
+
+# 作品詳情接口，打開視頻頁面時請求，返回 aweme_detail（含最新簽名的播放地址）
+AWEME_DETAIL_API_PATTERN = 'aweme/v1/web/aweme/detail'
+VIDEO_PAGE_URL = 'https://www.douyin.com/video/{}'
+
+# 播放地址帶有簽名和有效期，過期後 CDN 返回這些狀態碼，需要重新獲取地址
+EXPIRED_STATUS_CODES = (403, 410)
+
+# 啟動 Chrome 時使用的參數，BrowserManager 和 browser_daemon 共用；remote debugging 的地址和端口另外設置
+CHROME_ARGUMENTS = [
+    '--no-sandbox',
+    '--disable-dev-shm-usage',
+    # '--disable-gpu',
+    '--disable-web-security',
+    '--disable-features=VizDisplayCompositor',
+    '--disable-extensions',
+    '--disable-plugins',
+    '--disable-setuid-sandbox',
+    '--headless=new',
+]
+
+def extension_patterns(*extensions):
+    """按擴展名生成只匹配 URL 路徑結尾（可帶查詢字符串）的通配符，不會匹配到查詢參數中出現的同樣文字"""
+    return [pattern for extension in extensions for pattern in (f'*://*/*.{extension}', f'*://*/*.{extension}?*')]
+
+
+# 瀏覽器中用 CDP（Network.setBlockedURLs）屏蔽的請求，按類別列出通配符；發現作品列表不需要這些資源
+BLOCKED_URL_PATTERNS = {
+    'font': extension_patterns('woff', 'woff2', 'ttf', 'otf'),
+    'image': extension_patterns('jpg', 'jpeg', 'png', 'gif', 'webp', 'avif', 'svg'),
+    'stylesheet': extension_patterns('css'),
+    'analytics': ['*mcs.zijieapi.com*', '*mon.zijieapi.com*', '*/monitor_browser/collect*', '*google-analytics.com*'],
+}
+# 視頻頁面的 DOM 抓取和媒體請求依賴正常的佈局，默認只屏蔽字體和統計請求
+DEFAULT_BLOCKED_RESOURCES = ('font', 'analytics')
+# 只讀取接口響應的發現標籤頁（滾動作品列表、獲取作品詳情）不需要渲染頁面，屏蔽所有類別
+DISCOVERY_BLOCKED_RESOURCES = ('font', 'image', 'stylesheet', 'analytics')
+
+# 複製瀏覽器用戶數據目錄時跳過的文件：進程鎖、調試端口和崩潰報告
+PROFILE_IGNORE_PATTERNS = ('Singleton*', 'lockfile', 'DevToolsActivePort', 'Crashpad', '*.tmp')
+
+# 下載清單默認保存在下載資料夾中
+MANIFEST_FILENAME = 'manifest.sqlite3'
+# 下載失敗達到這個次數的作品（或沒有視頻地址的作品）不再阻止增量同步的位置向前推進
+SYNC_MAX_FAILURES = 3
+
+# 作品列表接口返回的每一頁緩存在下載資料夾中，按 sec_user_id 和 cursor 保存
+FEED_CACHE_DIRNAME = 'feed_cache'
+FEED_CACHE_TTL = 3600                   # 緩存有效期（秒）
+FEED_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 超過後按最近使用時間淘汰
+
+# 導出到 Prometheus textfile 的指標說明
+METRIC_HELP = {
+    'douyin_stage_seconds_total': ('counter', '各階段累計耗時（秒）'),
+    'douyin_stage_runs_total': ('counter', '各階段執行次數'),
+    'douyin_stage_errors_total': ('counter', '各階段出錯次數'),
+    'douyin_downloads_total': ('counter', '視頻下載次數，按結果分類'),
+    'douyin_download_bytes_total': ('counter', '下載完成的字節數'),
+    'douyin_download_seconds_total': ('counter', '下載累計耗時（秒）'),
+    'douyin_download_retries_total': ('counter', '切換鏡像或重試的次數'),
+    'douyin_download_throughput_bytes': ('gauge', '最近一個下載完成的視頻的速度（字節/秒）'),
+}
+
+# 瀏覽器各步驟的等待上限（秒），條件滿足後立即繼續，可通過 timeouts 參數覆蓋
+DEFAULT_TIMEOUTS = {
+    'page_load': 15,    # page.get 等待頁面加載完成
+    'login_panel': 3,   # 等待登入介面出現
+    'popup_close': 3,   # 點擊關閉後等待彈窗消失
+    'feed_idle': 10,    # 作品列表多久沒有新項目時停止滾動
+    'media': 10,        # 等待視頻請求出現
+    'media_settle': 1,  # 第一個視頻請求之後繼續收集其他清晰度的時間
+    'hover': 1,         # 懸停後等待視頻預覽請求
+}
+
+# 寫入視頻時每次讀取的字節數，從 READ_CHUNK_MIN 開始，每次讀滿後加倍直到 READ_CHUNK_MAX
+READ_CHUNK_MIN = 64 * 1024
+READ_CHUNK_MAX = 1024 * 1024
+
+# 終端中進度行的刷新間隔（秒）；輸出不是終端時不刷新，每 PROGRESS_LOG_INTERVAL 秒記錄一條匯總日誌
+PROGRESS_INTERVAL = 0.1
+PROGRESS_LOG_INTERVAL = 10
+
+# 未完成的下載寫入 .part 文件，旁邊的 .part.json 記錄 URL、總大小和 ETag/Last-Modified
+PART_SUFFIX = '.part'
+PART_META_SUFFIX = '.json'
+
+
+class TokenBucket:
+    """線程安全的令牌桶，rate 為每秒補充的令牌數，capacity 為最多積累的令牌數"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """取走一個令牌並返回需要等待的秒數
+
+        令牌不足時可以預支，並行的請求按預支順序排隊，等待結束即可發出請求。
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(wait, self.paused_until - now)
+
+    def set_rate(self, rate):
+        """修改補充速率，已積累和預支的令牌保持不變"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = rate
+
+    def pause(self, seconds):
+        """在接下來的 seconds 秒內不發放令牌（用於 Retry-After）"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """所有 HTTP 請求共用的速率限制：一個全局令牌桶加每個主機一個令牌桶
+
+    主機返回 429 或 5xx 時該主機的速率乘以 decrease（並遵守 Retry-After），
+    其他成功響應後速率加 increase，速率最終會停在服務器實際允許的水平附近。
+    """
+
+    def __init__(self, global_rate=20, host_rate=2, host_min_rate=0.2, host_max_rate=20, host_burst=4,
+                 increase=0.2, decrease=0.5):
+        self.global_bucket = TokenBucket(global_rate)
+        self.host_rate = host_rate
+        self.host_min_rate = host_min_rate
+        self.host_max_rate = host_max_rate
+        self.host_burst = host_burst
+        self.increase = increase
+        self.decrease = decrease
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def host_bucket(self, url):
+        """返回 URL 所在主機的令牌桶"""
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = TokenBucket(self.host_rate, self.host_burst)
+            return self._hosts[host]
+
+    def acquire(self, url):
+        """等待直到可以向 url 發出請求"""
+        wait = max(self.host_bucket(url).reserve(), self.global_bucket.reserve())
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_response(self, url, status_code, retry_after=None):
+        """根據響應狀態碼調整主機速率"""
+        bucket = self.host_bucket(url)
+        if status_code == 429 or status_code >= 500:
+            rate = max(self.host_min_rate, bucket.rate * self.decrease)
+            bucket.set_rate(rate)
+            if retry_after and str(retry_after).isdigit():
+                bucket.pause(int(retry_after))
+            logger.info(f"{urlparse(url).netloc} 返回 {status_code}，請求速率降到每秒 {rate:.2f} 個")
+        elif status_code < 400:
+            bucket.set_rate(min(self.host_max_rate, bucket.rate + self.increase))
+
+
+class RateLimitedSession(requests.Session):
+    """每個請求發出前經過 RateLimiter，收到響應後把狀態碼反饋給它"""
+
+    def __init__(self, limiter=None):
+        super().__init__()
+        self.limiter = limiter
+
+    def request(self, method, url, *args, **kwargs):
+        if self.limiter is None:
+            return super().request(method, url, *args, **kwargs)
+        self.limiter.acquire(url)
+        response = super().request(method, url, *args, **kwargs)
+        self.limiter.on_response(url, response.status_code, response.headers.get('Retry-After'))
+        return response
+
+
+def create_http_session(pool_maxsize=DEFAULT_POOL_MAXSIZE, pool_connections=DEFAULT_POOL_MAXSIZE, limiter=None):
+    """創建所有請求共用的 requests.Session
+
+    連接保持 keep-alive 並在請求之間復用，每個文件不再重新進行 TCP 和 TLS 握手。
+    pool_maxsize 為每個主機保留的連接數，應不小於對同一主機的最大並行請求數；
+    pool_connections 為緩存連接池的主機數。傳入 limiter 時所有請求都經過該 RateLimiter。
+    """
+    session = RateLimitedSession(limiter)
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class URLExpiredError(Exception):
+    """視頻地址的簽名已過期（CDN 返回 403/410），需要重新獲取地址後重試"""
+
+
+def is_url_expired(error):
+    """判斷下載異常是否由於地址過期"""
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code in EXPIRED_STATUS_CODES
+
+
+def is_transient_error(error):
+    """判斷下載異常是否可能在換鏡像或稍後重試時恢復：連接錯誤、超時、中途斷開、速度過慢、429 和 5xx"""
+    response = getattr(error, 'response', None)
+    if response is not None:
+        return response.status_code == 429 or response.status_code >= 500
+    # requests 的異常和 SlowMirrorError、文件不完整都是 IOError；直接讀取連接時斷開會拋出 urllib3 的異常
+    return isinstance(error, (IOError, urllib3.exceptions.HTTPError))
+
+
+def probe_range_support(http, video_url, headers):
+    """檢查服務器是否支持 Range 請求，支持時返回文件總大小，否則返回 None"""
+    probe_headers = dict(headers)
+    probe_headers['Range'] = 'bytes=0-0'
+    response = http.get(video_url, headers=probe_headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    try:
+        if response.status_code != 206:
+            return None
+        # Content-Range: bytes 0-0/12345
+        content_range = response.headers.get('Content-Range', '')
+        match = re.match(r'bytes\s+0-0/(\d+)', content_range)
+        if not match:
+            return None
+        return int(match.group(1))
+    finally:
+        response.close()
+
+
+def probe_video_candidate(http, video_url, headers):
+    """用 Range: bytes=0-0 請求探測候選視頻，返回 (文件大小, Content-Type)，失敗時返回 None"""
+    probe_headers = dict(headers)
+    probe_headers['Range'] = 'bytes=0-0'
+    response = http.get(video_url, headers=probe_headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    try:
+        content_type = response.headers.get('Content-Type', '')
+        if response.status_code == 206:
+            match = re.match(r'bytes\s+0-0/(\d+)', response.headers.get('Content-Range', ''))
+            size = int(match.group(1)) if match else 0
+        elif response.status_code == 200:
+            # 服務器不支持 Range，只讀取響應頭中的大小，不下載內容
+            size = int(response.headers.get('Content-Length', 0))
+        else:
+            return None
+        return size, content_type
+    finally:
+        response.close()
+
+
+def preallocate(f, size):
+    """按 Content-Length 預先分配文件空間，減少碎片並提前發現磁盤空間不足"""
+    if size <= 0:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError as e:
+            # 空間不足時直接失敗，文件系統不支持時退回 truncate
+            if e.errno == errno.ENOSPC:
+                raise
+    f.truncate(size)
+
+
+def write_response(response, f, progress=None, offset=0, total_size=0):
+    """把響應內容從 f 的當前位置開始寫入，返回寫入的字節數
+
+    直接從連接讀入一個重複使用的緩衝區再寫入文件，不為每塊數據創建新的 bytes 對象；
+    每次讀取的大小從 READ_CHUNK_MIN 開始，讀滿後加倍直到 READ_CHUNK_MAX。
+    progress(已下載字節, 總字節) 中的已下載字節包含 offset，開始讀取前先以 offset 調用一次。
+    """
+    if progress:
+        progress(offset, total_size)
+    if response.headers.get('Content-Encoding', 'identity') not in ('', 'identity'):
+        # 服務器仍然壓縮了內容時交給 requests 解壓
+        written = 0
+        for chunk in response.iter_content(chunk_size=READ_CHUNK_MAX):
+            f.write(chunk)
+            written += len(chunk)
+            if progress:
+                progress(offset + written, total_size)
+        return written
+
+    buffer = memoryview(bytearray(READ_CHUNK_MAX))
+    chunk_size = READ_CHUNK_MIN
+    written = 0
+    while True:
+        n = response.raw.readinto(buffer[:chunk_size])
+        if not n:
+            break
+        f.write(buffer[:n])
+        written += n
+        if progress:
+            progress(offset + written, total_size)
+        if n == chunk_size and chunk_size < READ_CHUNK_MAX:
+            chunk_size *= 2
+    return written
+
+
+def download_ranges(http, video_url, filepath, headers, total_size, segments, progress=None):
+    """將文件分成多段並行下載到預先分配好大小的 .part 文件中，完成後重命名，返回是否成功
+
+    progress 為可選的回調 progress(已下載字節, 總字節)，已下載字節是各段之和，調用時持有鎖。
+    回調拋出異常時其餘分段在下一次回調時同樣中止，異常由本函數拋出。
+    """
+    segment_size = -(-total_size // segments)
+    ranges = [(start, min(start + segment_size, total_size) - 1)
+              for start in range(0, total_size, segment_size)]
+    part_path = filepath + PART_SUFFIX
+
+    # 預先分配的 .part 文件無法按偏移續傳，清除舊的續傳記錄
+    if os.path.exists(part_path + PART_META_SUFFIX):
+        os.remove(part_path + PART_META_SUFFIX)
+
+    # 預先分配文件大小，各段直接寫入對應位置
+    with open(part_path, 'wb') as f:
+        preallocate(f, total_size)
+
+    segment_progress = [0] * len(ranges)
+    progress_lock = threading.Lock()
+    progress_error = []
+
+    def range_callback(index):
+        def update(downloaded, _total_size):
+            with progress_lock:
+                if progress_error:
+                    raise progress_error[0]
+                segment_progress[index] = downloaded
+                try:
+                    progress(sum(segment_progress), total_size)
+                except Exception as e:
+                    progress_error.append(e)
+                    raise
+        return update
+
+    def fetch_range(index, byte_range):
+        start, end = byte_range
+        range_headers = dict(headers)
+        range_headers['Range'] = f'bytes={start}-{end}'
+        response = http.get(video_url, headers=range_headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        try:
+            if response.status_code != 206:
+                logger.warning(f"分段 {start}-{end} 下載失敗，狀態碼: {response.status_code}")
+                return False
+            with open(part_path, 'r+b') as f:
+                f.seek(start)
+                written = write_response(response, f, range_callback(index) if progress else None)
+            return written == end - start + 1
+        finally:
+            response.close()
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        results = list(executor.map(fetch_range, range(len(ranges)), ranges))
+
+    if not all(results):
+        return False
+    os.replace(part_path, filepath)
+    return True
+
+
+def load_part_meta(part_path):
+    """讀取 .part 文件的續傳記錄，記錄不存在或損壞時返回 None"""
+    meta_path = part_path + PART_META_SUFFIX
+    if not os.path.exists(part_path) or not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def download_resumable(http, video_url, filepath, headers, progress=None):
+    """下載到 .part 文件並在完成後原子重命名，存在續傳記錄時使用 Range 繼續下載
+
+    progress 為可選的回調 progress(已下載字節, 總字節)。返回文件大小，
+    狀態碼錯誤時拋出 requests.HTTPError，文件不完整時拋出 IOError。
+    """
+    part_path = filepath + PART_SUFFIX
+    meta_path = part_path + PART_META_SUFFIX
+    request_headers = dict(headers)
+
+    # 已有未完成的 .part 文件時，用 If-Range 確保服務器上的文件沒有變化
+    offset = 0
+    meta = load_part_meta(part_path)
+    if meta and meta.get('validator') and 0 < os.path.getsize(part_path) < meta.get('total_size', 0):
+        offset = os.path.getsize(part_path)
+        request_headers['Range'] = f'bytes={offset}-'
+        request_headers['If-Range'] = meta['validator']
+
+    response = http.get(video_url, headers=request_headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    if offset and response.status_code == 206:
+        # Content-Range: bytes 起點-終點/總大小，起點或總大小與 .part 文件不符時不能接在後面寫入，從頭重新下載
+        content_range = response.headers.get('Content-Range', '')
+        match = re.match(r'bytes\s+(\d+)-\d+/(\d+|\*)', content_range)
+        if not match or int(match.group(1)) != offset or match.group(2) not in ('*', str(meta['total_size'])):
+            logger.warning(f"續傳響應的 Content-Range 不符 ({content_range or '無'})，從頭重新下載")
+            response.close()
+            offset = 0
+            response = http.get(video_url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    try:
+        if offset and response.status_code == 206:
+            logger.info(f"從 {offset}/{meta['total_size']} 字節處繼續下載")
+            total_size = meta['total_size']
+            mode = 'r+b'
+        elif response.status_code == 200:
+            # 全新下載，或服務器上的文件已變化需要重新下載
+            offset = 0
+            total_size = int(response.headers.get('Content-Length', 0))
+            mode = 'wb'
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'url': video_url,
+                    'total_size': total_size,
+                    'validator': response.headers.get('ETag') or response.headers.get('Last-Modified'),
+                }, f)
+        else:
+            raise requests.HTTPError(f"狀態碼: {response.status_code}", response=response)
+
+        # 續傳位置取自 .part 文件的大小，這裡不預先分配空間：進程被強制結束時預分配的文件已是總大小，
+        # 下次無法判斷寫到了哪裡。預分配只用於不續傳的分段下載
+        with open(part_path, mode) as f:
+            f.seek(offset)
+            try:
+                write_response(response, f, progress, offset, total_size)
+            finally:
+                downloaded_size = f.tell()
+    finally:
+        response.close()
+
+    if total_size and downloaded_size != total_size:
+        raise IOError(f"文件不完整: {downloaded_size}/{total_size} 字節，下次運行時繼續下載")
+
+    os.replace(part_path, filepath)
+    os.remove(meta_path)
+    return downloaded_size
+
+
+def fetch_video(http, video_url, filepath, segments=1, progress=None):
+    """把單個地址下載到 filepath，返回文件大小，失敗時拋出異常
+
+    segments > 1 且服務器支持 Range、文件夠大時分段並行下載，否則使用可續傳的單連接下載。
+    """
+    if segments > 1:
+        total_size = probe_range_support(http, video_url, DOWNLOAD_HEADERS)
+        if total_size and total_size >= SEGMENT_MIN_SIZE * 2:
+            if not download_ranges(http, video_url, filepath, DOWNLOAD_HEADERS, total_size, segments, progress):
+                raise IOError(f"分段下載失敗 ({segments} 段)")
+            return total_size
+    return download_resumable(http, video_url, filepath, DOWNLOAD_HEADERS, progress)
+
+
+class SlowMirrorError(IOError):
+    """鏡像的下載速度低於 SLOW_MIRROR_THROUGHPUT"""
+
+
+class ThroughputWatch:
+    """下載進度回調：開始 grace 秒後平均速度低於 min_throughput 時拋出 SlowMirrorError 中止下載
+
+    從第一次回調開始計時，不包括建立連接前在 RateLimiter 中等待的時間。
+    progress 為可選的下一個進度回調，例如 ProgressReporter.callback() 的返回值。
+    """
+
+    def __init__(self, min_throughput=SLOW_MIRROR_THROUGHPUT, grace=SLOW_MIRROR_GRACE, progress=None):
+        self.min_throughput = min_throughput
+        self.grace = grace
+        self.progress = progress
+        self.start = None
+        self.base = None
+
+    def __call__(self, downloaded, total_size):
+        if self.progress:
+            self.progress(downloaded, total_size)
+        # 續傳時 downloaded 包含之前已下載的部分，以第一次回調時的時間和值為起點
+        if self.start is None:
+            self.start = time.monotonic()
+            self.base = downloaded
+        elapsed = time.monotonic() - self.start
+        if elapsed > self.grace:
+            throughput = (downloaded - self.base) / elapsed
+            if throughput < self.min_throughput:
+                raise SlowMirrorError(f"下載速度過慢: {throughput / 1024:.0f} KB/s")
+
+
+class MirrorSelector:
+    """記錄每個 CDN 主機的延遲、吞吐量和最近的失敗，為 url_list 中的鏡像排序
+
+    第一次遇到的主機用 Range 0-0 請求探測延遲，結果按主機緩存，後面的視頻直接使用。
+    """
+
+    def __init__(self, http, failure_ttl=MIRROR_FAILURE_TTL):
+        self.http = http
+        self.failure_ttl = failure_ttl
+        # host -> {'latency': 秒, 'throughput': 字節/秒, 'failed_at': 時間}
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def host_stats(self, url):
+        """返回 URL 所在主機的統計，沒有時創建"""
+        host = urlparse(url).netloc
+        with self._lock:
+            return self.hosts.setdefault(host, {'latency': None, 'throughput': None, 'failed_at': None})
+
+    def probe(self, url):
+        """測量到鏡像的首字節延遲並記錄，連接失敗時記錄為失敗"""
+        stats = self.host_stats(url)
+        probe_headers = dict(DOWNLOAD_HEADERS)
+        probe_headers['Range'] = 'bytes=0-0'
+        try:
+            response = self.http.get(url, headers=probe_headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+            response.close()
+        except Exception as e:
+            logger.warning(f"探測鏡像失敗: {urlparse(url).netloc}, 錯誤: {e}")
+            self.record_failure(url)
+            return
+        # 403/410 是簽名的問題，與主機是否健康無關
+        if response.status_code >= 500:
+            self.record_failure(url)
+        # elapsed 從發出請求到收到響應頭，不包括在 RateLimiter 中等待的時間
+        with self._lock:
+            stats['latency'] = response.elapsed.total_seconds()
+
+    def rank(self, urls):
+        """按主機健康程度排序：最近失敗的排最後，其餘按預計下載 1MB 所需時間排序"""
+        now = time.time()
+
+        def recently_failed(stats):
+            return stats['failed_at'] is not None and now - stats['failed_at'] < self.failure_ttl
+
+        # 只探測還沒有延遲數據的主機，最近失敗的主機等失敗記錄過期後再探測
+        if len(urls) > 1:
+            for url in urls:
+                stats = self.host_stats(url)
+                if stats['latency'] is None and not recently_failed(stats):
+                    self.probe(url)
+
+        def score(url):
+            stats = self.host_stats(url)
+            failed = recently_failed(stats)
+            latency = stats['latency'] if stats['latency'] is not None else float('inf')
+            if stats['throughput']:
+                latency += 1024 * 1024 / stats['throughput']
+            return failed, latency
+
+        return sorted(urls, key=score)
+
+    def record_success(self, url, size, elapsed):
+        """記錄一次成功的下載，吞吐量取滑動平均"""
+        stats = self.host_stats(url)
+        with self._lock:
+            stats['failed_at'] = None
+            if size and elapsed > 0:
+                throughput = size / elapsed
+                stats['throughput'] = throughput if not stats['throughput'] else 0.7 * stats['throughput'] + 0.3 * throughput
+
+    def record_failure(self, url):
+        """記錄主機失敗，一段時間內排到最後"""
+        stats = self.host_stats(url)
+        with self._lock:
+            stats['failed_at'] = time.time()
+
+
+def download_from_mirrors(selector, urls, fetch, retries=MIRROR_RETRIES, backoff=MIRROR_BACKOFF, on_retry=None,
+                          progress=None):
+    """按 selector 的排序依次調用 fetch(url, progress) 下載，返回 fetch 的結果
+
+    出錯時切換到下一個鏡像；所有鏡像都失敗後按指數退避等待，最多嘗試 retries 輪，最後拋出最後一個錯誤。
+    只有 is_transient_error 的錯誤（連接錯誤、超時、429/5xx、速度過慢）才會在下一輪重試，404 等錯誤的地址不再嘗試。
+    地址過期（403/410）時其他鏡像的簽名同樣過期，直接拋出。沒有可用的地址時拋出 IOError。
+    每次失敗後調用可選的 on_retry(url, 錯誤)；可選的 progress 接收所有鏡像的下載進度。
+    """
+    last_error = None
+    dead_urls = set()
+    for attempt in range(retries):
+        candidates = [url for url in urls if url not in dead_urls]
+        if not candidates:
+            break
+        if attempt:
+            wait = backoff * 2 ** (attempt - 1)
+            logger.warning(f"所有鏡像都下載失敗，{wait} 秒後重試 ({attempt + 1}/{retries})")
+            time.sleep(wait)
+        for url in selector.rank(candidates):
+            watch = ThroughputWatch(progress=progress)
+            try:
+                size = fetch(url, watch)
+            except Exception as e:
+                if is_url_expired(e):
+                    raise
+                if is_transient_error(e):
+                    selector.record_failure(url)
+                else:
+                    dead_urls.add(url)
+                last_error = e
+                logger.warning(f"鏡像 {urlparse(url).netloc} 下載失敗: {e}")
+                if on_retry:
+                    on_retry(url, e)
+                continue
+            # 從第一次進度回調（收到響應頭）開始計時，不包括在 RateLimiter 中等待和探測 Range 的時間；
+            # 續傳時只計算本次傳輸的字節
+            if watch.start is not None:
+                selector.record_success(url, size - watch.base, time.monotonic() - watch.start)
+            else:
+                selector.record_success(url, 0, 0)
+            return size
+    if last_error is None:
+        raise IOError("沒有可用的下載地址")
+    raise last_error
+
+
+class Metrics:
+    """記錄各階段耗時和下載結果，以 JSON lines 逐條寫出，並匯總為 Prometheus textfile
+
+    jsonl_path 和 prom_path 都為 None 時只在內存中匯總。stage() 用於計時一個階段，
+    record_download() 記錄一個視頻的下載結果，write_prometheus() 寫出當前的匯總值。
+    """
+
+    def __init__(self, jsonl_path=None, prom_path=None):
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        # (指標名, 排序後的標籤) -> 值
+        self.values = {}
+        self._lock = threading.Lock()
+        self._jsonl = open(jsonl_path, 'a', encoding='utf-8') if jsonl_path else None
+
+    def emit(self, event, **fields):
+        """寫出一條 JSON lines 記錄"""
+        if self._jsonl is None:
+            return
+        line = json.dumps(dict({'ts': time.time(), 'event': event}, **fields), ensure_ascii=False)
+        with self._lock:
+            self._jsonl.write(line + '\n')
+            self._jsonl.flush()
+
+    def incr(self, name, value=1, **labels):
+        """累加計數器"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """設置 gauge 的值"""
+        with self._lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """計時一個階段，出錯時記錄錯誤並繼續拋出；fields 只寫入 JSON lines，不作為 Prometheus 標籤"""
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except GeneratorExit:
+            # 下游提前停止讀取生成器不算出錯
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.incr('douyin_stage_seconds_total', elapsed, stage=name)
+            self.incr('douyin_stage_runs_total', stage=name)
+            if error is not None:
+                self.incr('douyin_stage_errors_total', stage=name)
+            self.emit('stage', stage=name, seconds=round(elapsed, 4), ok=error is None,
+                      error=str(error) if error is not None else None, **fields)
+
+    def record_download(self, filename, size, elapsed, retries=0, result='ok', error=None):
+        """記錄一個視頻的下載結果，result 為 ok、failed 或 expired"""
+        throughput = size / elapsed if size and elapsed > 0 else 0
+        self.incr('douyin_downloads_total', result=result)
+        self.incr('douyin_download_seconds_total', elapsed)
+        self.incr('douyin_download_retries_total', retries)
+        if result == 'ok':
+            self.incr('douyin_download_bytes_total', size or 0)
+            self.set('douyin_download_throughput_bytes', throughput)
+        self.emit('download', file=filename, bytes=size or 0, seconds=round(elapsed, 4),
+                  bytes_per_s=round(throughput), retries=retries, result=result,
+                  error=str(error) if error is not None else None)
+
+    def write_prometheus(self):
+        """把匯總值寫入 prom_path（node_exporter textfile 格式），先寫臨時文件再原子替換"""
+        if not self.prom_path:
+            return
+        with self._lock:
+            values = sorted(self.values.items())
+        lines = []
+        written_help = set()
+        for (name, labels), value in values:
+            if name not in written_help:
+                kind, help_text = METRIC_HELP.get(name, ('untyped', name))
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                written_help.add(name)
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+        directory = os.path.dirname(os.path.abspath(self.prom_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.prom_path)
+
+    def close(self):
+        """寫出最終的匯總值並關閉 JSON lines 文件"""
+        self.write_prometheus()
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
+
+
+def format_bytes(size):
+    """把字節數格式化為 B/KB/MB/GB"""
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def is_tty(stream):
+    """stream 是否為終端"""
+    isatty = getattr(stream, 'isatty', None)
+    return bool(isatty and isatty())
+
+
+def truncate_display(text, width):
+    """按終端顯示寬度截斷文本，中文等全角字符佔兩列"""
+    used = 0
+    for i, char in enumerate(text):
+        used += 2 if unicodedata.east_asian_width(char) in ('W', 'F') else 1
+        if used > width:
+            return text[:i]
+    return text
+
+
+class JsonLogFormatter(logging.Formatter):
+    """每條日誌輸出為一行 JSON，輸出被重定向到文件或管道時使用"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(level=logging.INFO, stream=None):
+    """配置日誌輸出，在命令行入口調用一次
+
+    stream 默認為 sys.stdout。終端中只顯示消息，並先清除 ProgressReporter 的進度行；
+    不是終端時每條日誌輸出一行 JSON。
+    """
+    stream = stream or sys.stdout
+    handler = logging.StreamHandler(stream)
+    if is_tty(stream):
+        handler.setFormatter(logging.Formatter('\r\x1b[K%(message)s'))
+    else:
+        handler.setFormatter(JsonLogFormatter())
+    logging.basicConfig(level=level, handlers=[handler], force=True)
+
+
+class ProgressReporter:
+    """匯總所有進行中下載的進度，按固定頻率輸出，取代每個數據塊都打印一次
+
+    終端中最多每 interval 秒在同一行刷新總速度和各文件的進度、速度；輸出不是終端時不刷新，
+    只每 log_interval 秒記錄一條匯總日誌。callback(name) 返回可傳給下載函數的進度回調，
+    文件下載結束後調用 finish(name)。所有方法都是線程安全的。
+    """
+
+    def __init__(self, stream=None, interval=PROGRESS_INTERVAL, log_interval=PROGRESS_LOG_INTERVAL):
+        self.stream = stream or sys.stdout
+        self.tty = is_tty(self.stream)
+        self.interval = interval if self.tty else log_interval
+        # name -> {'downloaded': 字節, 'total': 字節, 'base': 第一次回調時的字節, 'start': 時間}
+        self.files = {}
+        # 從第一個下載開始到所有下載結束之間已完成的字節數，用於計算總速度
+        self.finished_bytes = 0
+        self.start = None
+        self._last_render = 0
+        self._line_shown = False
+        self._lock = threading.Lock()
+
+    def callback(self, name):
+        """返回 name 對應的進度回調 progress(已下載字節, 總字節)"""
+        def progress(downloaded, total_size):
+            self.update(name, downloaded, total_size)
+        return progress
+
+    def update(self, name, downloaded, total_size):
+        """更新一個文件的進度，距離上次輸出不足 interval 秒時只記錄不輸出"""
+        now = time.monotonic()
+        with self._lock:
+            if self.start is None:
+                self.start = now
+                if not self.tty:
+                    # 不是終端時第一條匯總日誌在 log_interval 之後輸出
+                    self._last_render = now
+            entry = self.files.get(name)
+            if entry is None:
+                # 續傳時 downloaded 包含之前已下載的部分，速度從第一次回調時算起
+                entry = self.files[name] = {'base': downloaded, 'start': now}
+            entry['downloaded'] = downloaded
+            entry['total'] = total_size
+            if now - self._last_render < self.interval:
+                return
+            self._last_render = now
+            self._render(now)
+
+    def finish(self, name):
+        """結束一個文件的進度，返回 (本次下載的字節數, 平均速度)"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self.files.pop(name, None)
+            size = max(entry['downloaded'] - entry['base'], 0) if entry else 0
+            self.finished_bytes += size
+            if not self.files:
+                self.start = None
+                self.finished_bytes = 0
+                self._clear_line()
+        if not entry:
+            return 0, 0
+        elapsed = now - entry['start']
+        return size, size / elapsed if elapsed > 0 else 0
+
+    def close(self):
+        """清除終端中的進度行"""
+        with self._lock:
+            self._clear_line()
+
+    def _clear_line(self):
+        if self._line_shown:
+            self.stream.write('\r\x1b[K')
+            self.stream.flush()
+            self._line_shown = False
+
+    def _render(self, now):
+        active = sum(max(entry['downloaded'] - entry['base'], 0) for entry in self.files.values())
+        elapsed = now - self.start
+        overall = (self.finished_bytes + active) / elapsed if elapsed > 0 else 0
+        parts = [f"總速度 {format_bytes(overall)}/s", f"{len(self.files)} 個下載中"]
+        for name, entry in self.files.items():
+            file_elapsed = now - entry['start']
+            rate = (entry['downloaded'] - entry['base']) / file_elapsed if file_elapsed > 0 else 0
+            if entry['total']:
+                done = f"{entry['downloaded'] / entry['total'] * 100:.0f}%"
+            else:
+                done = format_bytes(entry['downloaded'])
+            parts.append(f"{name} {done} {format_bytes(max(rate, 0))}/s")
+        line = ' | '.join(parts)
+        if self.tty:
+            width = shutil.get_terminal_size().columns
+            self.stream.write('\r\x1b[K' + truncate_display(line, width - 1))
+            self.stream.flush()
+            self._line_shown = True
+        else:
+            logger.info(line)
+
+
+class MediaCapture:
+    """只記錄頁面中視頻資源的 URL，不讀取響應內容
+
+    page.listen 會為每個匹配的請求讀取完整響應內容，對視頻來說既佔內存又要等到傳輸結束。
+    這裡直接在頁面的 CDP 連接上處理 Network.responseReceived，收到響應頭就記錄。
+    """
+
+    def __init__(self, page):
+        self.page = page
+        self._urls = queue.Queue()
+
+    def start(self):
+        """開始記錄"""
+        self.page.run_cdp('Network.enable')
+        self.page.driver.set_callback('Network.responseReceived', self._on_response)
+
+    def stop(self):
+        """停止記錄
+
+        不關閉 Network 域：BrowserManager 設置的請求屏蔽依賴它，關閉後屏蔽會失效。
+        """
+        self.page.driver.set_callback('Network.responseReceived', None)
+
+    def clear(self):
+        """清除尚未取出的 URL"""
+        while not self._urls.empty():
+            self._urls.get_nowait()
+
+    def wait(self, timeout):
+        """等待下一個視頻 URL，超時返回 None"""
+        try:
+            return self._urls.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _on_response(self, **kwargs):
+        response = kwargs.get('response', {})
+        url = response.get('url', '')
+        if not url.startswith('http'):
+            return
+        if kwargs.get('type') == 'Media' or response.get('mimeType', '').startswith('video/'):
+            self._urls.put(url)
+
+
+def packet_json(packet):
+    """將監聽到的數據包內容解析為 JSON，無法解析時返回 None"""
+    try:
+        body = packet.response.body
+    except Exception:
+        return None
+    if isinstance(body, dict):
+        return body
+    if isinstance(body, (str, bytes)) and body:
+        try:
+            return json.loads(body)
+        except ValueError:
+            return None
+    return None
+
+
+def packet_cursor(packet):
+    """返回作品列表請求的 max_cursor 參數，第一頁為 '0'"""
+    query = parse_qs(urlparse(packet.url).query)
+    return query.get('max_cursor', ['0'])[0]
+
+
+def filter_new_items(aweme_list, seen_ids, since_create_time=None):
+    """從一頁作品中挑出未見過的項目，返回 (新項目, 是否已到達上次同步的位置)"""
+    new_items = []
+    reached_known = False
+    for item in aweme_list or []:
+        aweme_id = item.get('aweme_id')
+        if aweme_id in seen_ids:
+            continue
+        if since_create_time and (item.get('create_time') or 0) <= since_create_time:
+            # 置頂作品可能比上次同步的位置還舊，不能用來判斷是否已到達
+            if not item.get('is_top'):
+                reached_known = True
+            continue
+        seen_ids.add(aweme_id)
+        new_items.append(item)
+    return new_items, reached_known
+
+
+def iter_post_feed(page, idle_timeout=10, scroll_interval=1, since_create_time=None, cache=None, sec_user_id=None):
+    """持續滾動用戶主頁並逐頁 yield aweme 項目
+
+    page 需要在打開用戶主頁前以 POST_API_PATTERN 開始監聽。接口返回 has_more 為 0，
+    或 idle_timeout 秒內沒有新的項目時停止。傳入 since_create_time 時只 yield 比它新的作品，
+    遇到不晚於它的非置頂作品即停止（增量同步）。傳入 cache 時每一頁都會寫入 FeedCache。
+    """
+    seen_ids = set()
+    pages = 0
+    deadline = time.time() + idle_timeout
+    page.scroll.to_bottom()
+
+    while time.time() < deadline:
+        packet = page.listen.wait(timeout=scroll_interval)
+        if not packet:
+            # 還沒有新的請求，繼續滾動觸發下一頁
+            page.scroll.to_bottom()
+            continue
+
+        data = packet_json(packet)
+        if not data or 'aweme_list' not in data:
+            continue
+
+        pages += 1
+        if cache is not None and sec_user_id:
+            cache.put(sec_user_id, packet_cursor(packet), data)
+        new_items, reached_known = filter_new_items(data.get('aweme_list'), seen_ids, since_create_time)
+        logger.info(f"第 {pages} 頁: {len(new_items)} 個新視頻")
+
+        for item in new_items:
+            yield item
+
+        # 下游處理的時間不計入等待時間
+        if new_items:
+            deadline = time.time() + idle_timeout
+
+        if reached_known:
+            logger.info(f"已到達上次同步的位置，共 {len(seen_ids)} 個新視頻")
+            return
+
+        if not data.get('has_more'):
+            logger.info(f"已到達作品列表末尾，共 {len(seen_ids)} 個視頻")
+            return
+
+        page.scroll.to_bottom()
+
+    logger.info(f"{idle_timeout} 秒內沒有新的視頻，停止滾動，共 {len(seen_ids)} 個視頻")
+
+
+class PostApiError(Exception):
+    """作品列表接口沒有返回可用的數據（未簽名的請求被拒絕、需要登入等），需要改用瀏覽器獲取"""
+
+
+def build_post_api_url(sec_user_id, max_cursor=0, count=POST_API_PAGE_SIZE, api_url=POST_API_URL):
+    """構建作品列表接口某一頁的請求地址"""
+    params = dict(POST_API_PARAMS, sec_user_id=sec_user_id, max_cursor=max_cursor, count=count)
+    return f"{api_url}?{urlencode(params)}"
+
+
+def fetch_post_page(http, api_url):
+    """請求作品列表接口的一頁並返回解析後的 JSON
+
+    cookies 和請求頭使用 http（Session）上的設置。狀態碼不是 200、響應為空、沒有 aweme_list
+    或接口返回的 status_code 不為 0 時拋出 PostApiError。
+    """
+    response = http.get(api_url)
+    logger.debug(f"HTTP狀態碼: {response.status_code}")
+    logger.debug(f"響應內容前500字符: {response.text[:500]}")
+    if response.status_code != 200:
+        raise PostApiError(f"請求失敗，狀態碼: {response.status_code}")
+    if not response.text.strip():
+        raise PostApiError("響應為空")
+    try:
+        data = response.json()
+    except ValueError as e:
+        raise PostApiError(f"JSON解析失敗: {e}") from e
+    if not isinstance(data, dict) or 'aweme_list' not in data:
+        keys = list(data.keys()) if isinstance(data, dict) else type(data).__name__
+        raise PostApiError(f"響應中未找到aweme_list，可用的鍵: {keys}")
+    if data.get('status_code'):
+        raise PostApiError(f"接口返回錯誤，status_code: {data['status_code']}，{data.get('status_msg') or ''}")
+    return data
+
+
+def iter_post_api(fetch_page, sec_user_id, since_create_time=None, cache=None, page_size=POST_API_PAGE_SIZE,
+                  api_url=POST_API_URL):
+    """沿 max_cursor 逐頁請求作品列表接口並 yield aweme 項目，不需要瀏覽器
+
+    fetch_page(請求地址) 返回一頁的 JSON，例如 DouyinVideoDownloader.fetch_post_page；出錯時的異常直接拋出。
+    has_more 為 0 或到達 since_create_time 時停止（與 iter_post_feed 相同），傳入 cache 時每一頁都會寫入 FeedCache。
+    第一頁為空時拋出 PostApiError：未通過風控的請求也會返回空列表，無法和沒有作品的用戶區分，交給瀏覽器確認。
+    """
+    seen_ids = set()
+    pages = 0
+    cursor = '0'
+    visited = set()
+    while cursor not in visited:
+        visited.add(cursor)
+        data = fetch_page(build_post_api_url(sec_user_id, cursor, page_size, api_url))
+        pages += 1
+        if pages == 1 and not data.get('aweme_list'):
+            raise PostApiError("第一頁的作品列表為空")
+        if cache is not None:
+            cache.put(sec_user_id, cursor, data)
+        new_items, reached_known = filter_new_items(data.get('aweme_list'), seen_ids, since_create_time)
+        logger.info(f"第 {pages} 頁: {len(new_items)} 個新視頻")
+
+        for item in new_items:
+            yield item
+
+        if reached_known:
+            logger.info(f"已到達上次同步的位置，共 {len(seen_ids)} 個新視頻")
+            return
+        if not data.get('has_more'):
+            logger.info(f"已到達作品列表末尾，共 {len(seen_ids)} 個視頻")
+            return
+        cursor = str(data.get('max_cursor'))
+    # max_cursor 沒有前進時停止，避免重複請求同一頁
+    logger.warning(f"作品列表的 max_cursor 沒有變化，停止翻頁，共 {len(seen_ids)} 個視頻")
+
+
+def resolve_aweme_details(page, aweme_ids, timeout=10, page_load_timeout=15):
+    """在同一個頁面中逐個打開視頻頁面，從作品詳情接口批量獲取最新的 aweme 數據
+
+    返回 {aweme_id: aweme}，沒有拿到詳情的 aweme_id 不在結果中。
+    """
+    details = {}
+    page.listen.start(AWEME_DETAIL_API_PATTERN, res_type=POST_API_RES_TYPES)
+    try:
+        for aweme_id in aweme_ids:
+            aweme_id = str(aweme_id)
+            if aweme_id in details:
+                continue
+            page.get(VIDEO_PAGE_URL.format(aweme_id), timeout=page_load_timeout)
+            # 上一個頁面的請求可能晚到，按 aweme_id 匹配，也順便保存
+            deadline = time.time() + timeout
+            while aweme_id not in details and time.time() < deadline:
+                packet = page.listen.wait(timeout=max(deadline - time.time(), 0.1))
+                if not packet:
+                    break
+                item = (packet_json(packet) or {}).get('aweme_detail')
+                if item and item.get('aweme_id'):
+                    details[str(item['aweme_id'])] = item
+            if aweme_id not in details:
+                logger.info(f"未獲取到作品詳情: {aweme_id}")
+    finally:
+        page.listen.stop()
+    return details
+
+
+def extract_aweme_id(url):
+    """從視頻頁面 URL（/video/<aweme_id>）提取 aweme_id，找不到時返回 None"""
+    match = re.search(r'/video/(\d+)', url or '')
+    return match.group(1) if match else None
+
+
+def file_sha256(filepath):
+    """計算文件的 sha256"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DownloadManifest:
+    """以 aweme_id 為主鍵記錄已下載視頻的 SQLite 清單，重複運行時在任何網絡請求前跳過已下載的視頻"""
+
+    # SQLite 單條語句的參數數量有上限，批量查詢時分批進行
+    QUERY_BATCH = 500
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # 下載在多個線程中完成，共用一個連接並用鎖保護
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS downloads (
+                aweme_id TEXT PRIMARY KEY,
+                sec_user_id TEXT,
+                variant TEXT,
+                size INTEGER,
+                sha256 TEXT,
+                path TEXT,
+                downloaded_at REAL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_downloads_user ON downloads (sec_user_id)')
+        # 增量同步：每個用戶已發現的最新作品
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_sync (
+                sec_user_id TEXT PRIMARY KEY,
+                newest_aweme_id TEXT,
+                newest_create_time INTEGER,
+                synced_at REAL
+            )
+        ''')
+        # 下載失敗的次數，用於判斷增量同步是否可以越過這個作品
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS failures (
+                aweme_id TEXT PRIMARY KEY,
+                sec_user_id TEXT,
+                attempts INTEGER,
+                failed_at REAL
+            )
+        ''')
+        self.conn.commit()
+
+    def _select_ids(self, query, aweme_ids, params=()):
+        """以 aweme_ids 分批填入 query 中的 {placeholders} 執行查詢，返回結果第一列的集合"""
+        ids = list({str(aweme_id) for aweme_id in aweme_ids if aweme_id})
+        found = set()
+        with self._lock:
+            for start in range(0, len(ids), self.QUERY_BATCH):
+                batch = ids[start:start + self.QUERY_BATCH]
+                placeholders = ','.join('?' * len(batch))
+                rows = self.conn.execute(query.format(placeholders=placeholders), [*batch, *params])
+                found.update(row[0] for row in rows)
+        return found
+
+    def known_ids(self, aweme_ids):
+        """批量查詢，返回其中已下載的 aweme_id 集合"""
+        return self._select_ids('SELECT aweme_id FROM downloads WHERE aweme_id IN ({placeholders})', aweme_ids)
+
+    def record_failure(self, aweme_id, sec_user_id=None):
+        """記錄一次下載失敗（沒有可用的地址或所有鏡像都失敗）"""
+        if not aweme_id:
+            return
+        with self._lock:
+            self.conn.execute('''
+                INSERT INTO failures VALUES (?, ?, 1, ?)
+                ON CONFLICT (aweme_id) DO UPDATE SET
+                    attempts = failures.attempts + 1,
+                    failed_at = excluded.failed_at
+            ''', (str(aweme_id), sec_user_id, time.time()))
+            self.conn.commit()
+
+    def failed_ids(self, aweme_ids, min_attempts=SYNC_MAX_FAILURES):
+        """批量查詢，返回其中下載失敗至少 min_attempts 次的 aweme_id 集合"""
+        return self._select_ids('SELECT aweme_id FROM failures WHERE aweme_id IN ({placeholders}) AND attempts >= ?',
+                               aweme_ids, (min_attempts,))
+
+    def contains(self, aweme_id):
+        """檢查單個視頻是否已下載"""
+        return bool(aweme_id) and str(aweme_id) in self.known_ids([aweme_id])
+
+    def record(self, aweme_id, filepath, sec_user_id=None, variant=None):
+        """記錄下載完成的視頻，大小和 sha256 從磁盤上的文件計算"""
+        size = os.path.getsize(filepath)
+        sha256 = file_sha256(filepath)
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (str(aweme_id), sec_user_id, variant, size, sha256, filepath, time.time()),
+            )
+            self.conn.commit()
+
+    def get_last_seen(self, sec_user_id):
+        """返回用戶上次同步到的 (aweme_id, create_time)，沒有記錄時返回 (None, None)"""
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT newest_aweme_id, newest_create_time FROM user_sync WHERE sec_user_id = ?', (sec_user_id,)
+            ).fetchone()
+        return row if row else (None, None)
+
+    def update_last_seen(self, sec_user_id, aweme_id, create_time):
+        """更新用戶的同步位置，只會向更新的作品移動"""
+        with self._lock:
+            self.conn.execute('''
+                INSERT INTO user_sync VALUES (?, ?, ?, ?)
+                ON CONFLICT (sec_user_id) DO UPDATE SET
+                    newest_aweme_id = excluded.newest_aweme_id,
+                    newest_create_time = excluded.newest_create_time,
+                    synced_at = excluded.synced_at
+                WHERE excluded.newest_create_time > user_sync.newest_create_time
+            ''', (sec_user_id, str(aweme_id), create_time, time.time()))
+            self.conn.commit()
+
+    def close(self):
+        """關閉數據庫連接"""
+        with self._lock:
+            self.conn.close()
+
+
+class FeedCache:
+    """作品列表接口響應的磁盤緩存，每頁一個 JSON 文件，按 (sec_user_id, cursor) 索引
+
+    超過 ttl 秒的頁面視為過期；總大小超過 max_bytes 時按最近使用時間（文件 mtime）淘汰最舊的頁面。
+    """
+
+    def __init__(self, cache_dir, ttl=FEED_CACHE_TTL, max_bytes=FEED_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def page_path(self, sec_user_id, cursor):
+        """返回某一頁的緩存文件路徑"""
+        key = hashlib.sha1(f'{sec_user_id}:{cursor}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, sec_user_id, cursor):
+        """讀取未過期的一頁響應，沒有或已過期時返回 None"""
+        path = self.page_path(sec_user_id, cursor)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get('fetched_at', 0) > self.ttl:
+            self.remove(path)
+            return None
+        # mtime 記錄最近使用時間，用於 LRU 淘汰
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry.get('data')
+
+    def put(self, sec_user_id, cursor, data):
+        """寫入一頁響應，寫入後檢查總大小並淘汰"""
+        path = self.page_path(sec_user_id, str(cursor))
+        entry = {
+            'sec_user_id': sec_user_id,
+            'cursor': str(cursor),
+            'fetched_at': time.time(),
+            'data': data,
+        }
+        with self._lock:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            self.evict()
+
+    def remove(self, path):
+        """刪除緩存文件，文件已不存在時忽略"""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        """刪除過期頁面，並在總大小超過 max_bytes 時從最久未使用的頁面開始刪除"""
+        now = time.time()
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            # 寫入後不再修改內容，mtime 不早於寫入時間，超過 ttl 未使用的一定已過期
+            if now - stat.st_mtime > self.ttl:
+                self.remove(path)
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    def load_feed(self, sec_user_id, since_create_time=None):
+        """從 cursor 0 開始沿 max_cursor 讀取緩存的所有頁面
+
+        緩存一直連續到 has_more 為 0（或到達 since_create_time）時返回過濾後的作品列表，
+        中間缺頁或過期時返回 None，調用方需要重新用瀏覽器獲取。
+        """
+        seen_ids = set()
+        items = []
+        cursor = '0'
+        visited = set()
+        while cursor not in visited:
+            visited.add(cursor)
+            data = self.get(sec_user_id, cursor)
+            if not data:
+                return None
+            new_items, reached_known = filter_new_items(data.get('aweme_list'), seen_ids, since_create_time)
+            items.extend(new_items)
+            if reached_known or not data.get('has_more'):
+                return items
+            cursor = str(data.get('max_cursor'))
+        return None
+
+
+def has_video_urls(item):
+    """aweme 項目中是否有可下載的視頻地址（圖文作品等沒有）"""
+    video = item.get('video') or {}
+    if (video.get('play_addr') or {}).get('url_list'):
+        return True
+    return any((bit_rate.get('play_addr') or {}).get('url_list') for bit_rate in video.get('bit_rate') or [])
+
+
+def advance_sync_state(manifest, sec_user_id, items):
+    """下載結束後推進用戶的同步位置，items 為本次完整發現的作品（發現中途出錯時不要調用）
+
+    從最舊的作品開始，推進到第一個未下載的作品之前，下載失敗或還未下載的作品下次增量同步時仍會重新獲取。
+    沒有視頻地址、或已失敗 SYNC_MAX_FAILURES 次的作品不會重試成功，直接越過。置頂作品不參與。
+    """
+    if not sec_user_id:
+        return
+    feed = sorted((item for item in items if not item.get('is_top') and item.get('aweme_id')),
+                  key=lambda item: item.get('create_time') or 0)
+    known = manifest.known_ids(item['aweme_id'] for item in feed)
+    failed = manifest.failed_ids(item['aweme_id'] for item in feed if str(item['aweme_id']) not in known)
+    newest = None
+    for item in feed:
+        aweme_id = str(item['aweme_id'])
+        if aweme_id not in known:
+            if has_video_urls(item) and aweme_id not in failed:
+                break
+            logger.warning(f"作品 {aweme_id} 無法下載，增量同步不再等待它")
+        newest = item
+    if newest:
+        manifest.update_last_seen(sec_user_id, newest['aweme_id'], newest.get('create_time') or 0)
+
+
+def read_cookie_file(cookie_file):
+    """讀取 cookies 文件，返回 {name, value, domain, path, secure, httpOnly} 的列表，文件不存在時返回空列表
+
+    支持 JSON 格式（瀏覽器擴展導出的列表）和 Netscape 格式（cookies.txt，curl/yt-dlp 使用），
+    Netscape 格式中的會話 cookies 和已過期的 cookies 也會讀取。
+    """
+    if not cookie_file or not os.path.exists(cookie_file):
+        return []
+    with open(cookie_file, 'r', encoding='utf-8') as f:
+        content = f.read()
+    if content.lstrip().startswith(('[', '{')):
+        return json.loads(content)
+
+    jar = MozillaCookieJar()
+    jar.load(cookie_file, ignore_discard=True, ignore_expires=True)
+    return [{
+        'name': cookie.name,
+        'value': cookie.value,
+        'domain': cookie.domain,
+        'path': cookie.path,
+        'secure': cookie.secure,
+        'httpOnly': cookie.has_nonstandard_attr('HTTPOnly'),
+    } for cookie in jar]
+
+
+def inject_cookies(page, cookies):
+    """通過 CDP 一次性把 cookies 寫入瀏覽器，不需要先打開抖音頁面，返回寫入的數量"""
+    params = []
+    for cookie in cookies:
+        if not cookie.get('name') or not cookie.get('value'):
+            continue
+        params.append({
+            'name': cookie['name'],
+            'value': cookie['value'],
+            'domain': cookie.get('domain', '.douyin.com'),
+            'path': cookie.get('path', '/'),
+            'secure': bool(cookie.get('secure', False)),
+            'httpOnly': bool(cookie.get('httpOnly', False)),
+        })
+    if params:
+        page.run_cdp('Network.setCookies', cookies=params)
+    return len(params)
+
+
+def copy_profile(src, dst):
+    """複製瀏覽器用戶數據目錄，跳過 PROFILE_IGNORE_PATTERNS"""
+    shutil.copytree(src, dst, dirs_exist_ok=True, ignore=shutil.ignore_patterns(*PROFILE_IGNORE_PATTERNS))
+
+
+class BrowserManager:
+    """長期運行的 Chrome 瀏覽器，由下載器持有並在多次 run() 之間共用
+
+    第一次使用時才啟動，每次取用前做健康檢查，崩潰後自動重啟，需要調用 quit() 顯式關閉。
+    傳入 browser_address（host:port）時不啟動 Chrome，而是通過 CDP 連接已在運行的瀏覽器（例如 browser_daemon），
+    在新建的瀏覽器上下文中打開自己的標籤頁，quit() 只關閉這個上下文。每次啟動或連接都使用同一套設置：
+    - profile_template 為預熱的用戶數據目錄（只用於自己啟動的瀏覽器），存在時複製到本次的臨時目錄（保留 JS/HTTP 緩存，跳過首次運行的初始化），
+      不存在時在第一次正常關閉瀏覽器後由本次的目錄生成
+    - blocked_resources 中的類別（見 BLOCKED_URL_PATTERNS）在每個標籤頁中通過 CDP 屏蔽；disable_images 為 False 時不屏蔽圖片。
+      new_tab() 可以為單個標籤頁指定其他類別，例如發現標籤頁使用 DISCOVERY_BLOCKED_RESOURCES
+    - cookie_file 中的 cookies 在啟動後直接寫入瀏覽器
+    """
+
+    def __init__(self, chrome_path='/usr/bin/google-chrome', disable_images=True, metrics=None, profile_template=None,
+                 cookie_file=None, blocked_resources=DEFAULT_BLOCKED_RESOURCES, browser_address=None):
+        self.chrome_path = chrome_path
+        self.browser_address = browser_address
+        self.disable_images = disable_images
+        self.metrics = metrics or Metrics()
+        self.profile_template = profile_template
+        self.cookie_file = cookie_file
+        self.blocked_resources = [name for name in blocked_resources if disable_images or name != 'image']
+        self.page = None
+        self.user_data_dir = None
+        self.launch_count = 0
+        # 連接已有瀏覽器時的 Chromium 對象和本進程專用的瀏覽器上下文
+        self.chromium = None
+        self.context_id = None
+
+    def build_options(self):
+        """創建瀏覽器啟動參數"""
+        from DrissionPage import ChromiumOptions
+        co = ChromiumOptions()
+
+        # 改為 WSL2 上安裝的 Linux chromium
+        co.set_browser_path(self.chrome_path)
+
+        # 必要參數
+        for argument in CHROME_ARGUMENTS:
+            co.set_argument(argument)
+        co.set_argument('--remote-debugging-address=0.0.0.0')
+
+        # 設置用戶數據目錄避免衝突，瀏覽器存活期間一直使用同一個；有預熱的模板時從模板複製
+        self.user_data_dir = tempfile.mkdtemp(prefix='douyin-chrome-')
+        if self.profile_template and os.path.isdir(self.profile_template):
+            with self.metrics.stage('profile_copy'):
+                copy_profile(self.profile_template, self.user_data_dir)
+        co.set_user_data_path(self.user_data_dir)
+
+        # 自動選擇一個空閒端口並啟用 remote debugging
+        co.auto_port(9222)
+        co.set_argument(f'--remote-debugging-port={9222}')
+        return co
+
+    def start(self):
+        """啟動瀏覽器，設置了 browser_address 時改為連接已有的瀏覽器"""
+        from DrissionPage import ChromiumPage
+        if self.browser_address:
+            logger.info(f"正在連接瀏覽器: {self.browser_address}")
+        else:
+            logger.info("正在啟動Chrome瀏覽器...")
+        with self.metrics.stage('chrome_attach' if self.browser_address else 'chrome_launch'):
+            if self.browser_address:
+                self.page = self.attach()
+            else:
+                self.page = ChromiumPage(addr_or_opts=self.build_options())
+            self.prepare_tab(self.page)
+            try:
+                cookies_count = inject_cookies(self.page, read_cookie_file(self.cookie_file))
+                if cookies_count:
+                    logger.info(f"成功載入 {cookies_count} 個 cookies 到瀏覽器")
+            except Exception as e:
+                logger.warning(f"載入 cookies 到瀏覽器失敗: {e}")
+        self.launch_count += 1
+        return self.page
+
+    def attach(self):
+        """連接 browser_address 上的瀏覽器並新建一個瀏覽器上下文，返回其中的第一個標籤頁
+
+        每個上下文的 cookies、緩存和標籤頁相互獨立，多個進程共用同一個瀏覽器時不會互相影響。
+        """
+        from DrissionPage import Chromium, ChromiumOptions
+        co = ChromiumOptions(read_file=False).set_address(self.browser_address).existing_only(True)
+        self.chromium = Chromium(co)
+        self.context_id = self.chromium._run_cdp('Target.createBrowserContext')['browserContextId']
+        return self.open_context_tab()
+
+    def open_context_tab(self):
+        """在本進程的瀏覽器上下文中打開一個空白標籤頁"""
+        target_id = self.chromium._run_cdp('Target.createTarget', url='about:blank',
+                                           browserContextId=self.context_id)['targetId']
+        return self.chromium.get_tab(target_id)
+
+    def detach(self):
+        """關閉本進程的瀏覽器上下文（包括其中所有標籤頁），不關閉瀏覽器本身"""
+        try:
+            self.chromium._run_cdp('Target.disposeBrowserContext', browserContextId=self.context_id)
+        except Exception:
+            pass
+        self.chromium = None
+        self.context_id = None
+
+    def prepare_tab(self, tab, blocked_resources=None):
+        """在標籤頁中開啟 CDP 請求屏蔽，blocked_resources 為 None 時使用瀏覽器的默認類別"""
+        if blocked_resources is None:
+            blocked_resources = self.blocked_resources
+        patterns = [pattern for name in blocked_resources for pattern in BLOCKED_URL_PATTERNS[name]]
+        if not patterns:
+            return
+        try:
+            tab.run_cdp('Network.enable')
+            tab.run_cdp('Network.setBlockedURLs', urls=patterns)
+        except Exception as e:
+            logger.warning(f"設置請求屏蔽失敗: {e}")
+
+    def is_alive(self):
+        """檢查瀏覽器是否仍可用"""
+        if self.page is None:
+            return False
+        try:
+            return self.page.states.is_alive
+        except Exception:
+            return False
+
+    def get_page(self):
+        """返回可用的頁面，瀏覽器未啟動或已崩潰時（重新）啟動"""
+        if self.page is not None and not self.is_alive():
+            logger.info("瀏覽器已失去響應，重新啟動...")
+            self.quit(save_template=False)
+        if self.page is None:
+            self.start()
+        return self.page
+
+    def new_tab(self, url=None, blocked_resources=None):
+        """在共用的瀏覽器中打開新標籤頁，用於同時處理多個用戶；先開啟請求屏蔽再打開 url
+
+        blocked_resources 為這個標籤頁屏蔽的類別，為 None 時使用瀏覽器的默認類別。
+        """
+        page = self.get_page()
+        tab = self.open_context_tab() if self.browser_address else page.new_tab()
+        self.prepare_tab(tab, blocked_resources)
+        if url:
+            tab.get(url)
+        return tab
+
+    def save_profile_template(self):
+        """把本次的用戶數據目錄保存為預熱模板，先複製到臨時目錄再改名，避免留下不完整的模板"""
+        parent = os.path.dirname(os.path.abspath(self.profile_template))
+        os.makedirs(parent, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=parent)
+        try:
+            copy_profile(self.user_data_dir, tmp_dir)
+            os.rename(tmp_dir, self.profile_template)
+            logger.info(f"已保存瀏覽器模板: {self.profile_template}")
+        except OSError as e:
+            # 其他進程已經先保存了模板
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            logger.debug(f"保存瀏覽器模板失敗: {e}")
+
+    def quit(self, save_template=True):
+        """關閉瀏覽器並清理臨時目錄，還沒有預熱模板時先保存一份（崩潰後重啟時不保存）
+
+        連接的是已有的瀏覽器時只關閉本進程的上下文。
+        """
+        if self.browser_address:
+            if self.chromium is not None:
+                self.detach()
+            self.page = None
+            return
+        if self.page is not None:
+            try:
+                self.page.quit()
+            except Exception:
+                pass
+            self.page = None
+            if save_template and self.profile_template and self.user_data_dir and not os.path.isdir(self.profile_template):
+                self.save_profile_template()
+        if self.user_data_dir:
+            shutil.rmtree(self.user_data_dir, ignore_errors=True)
+            self.user_data_dir = None
 
 
 class DouyinVideoDownloader:
-    def __init__(self, download_folder="douyin_videos", cookie_file="cookies.json"):
+    def __init__(self, download_folder="douyin_videos", cookie_file="cookies.json", segments=1, timeouts=None,
+                 manifest_path=None, feed_cache_ttl=FEED_CACHE_TTL, feed_cache_max_bytes=FEED_CACHE_MAX_BYTES,
+                 pool_maxsize=None, rate_limits=None, metrics_jsonl=None, metrics_prom=None, profile_template=None,
+                 blocked_resources=DEFAULT_BLOCKED_RESOURCES, browser_address=None):
         self.download_folder = download_folder
         self.cookie_file = cookie_file
-        self.session = requests.Session()
+        # 各階段耗時和下載結果，可寫出為 JSON lines 和 Prometheus textfile
+        self.metrics = Metrics(metrics_jsonl, metrics_prom)
+        # 各步驟的等待上限，見 DEFAULT_TIMEOUTS
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        # 單個視頻的分段並行下載數，1 表示使用單個連接
+        self.segments = segments
+        # 多次 run() 共用同一個瀏覽器，使用完畢後調用 close() 關閉；啟動時從 profile_template 複製預熱的用戶數據，
+        # 屏蔽 blocked_resources 中的請求並載入 cookies。傳入 browser_address 時連接已在運行的瀏覽器
+        self.browser = BrowserManager(metrics=self.metrics, profile_template=profile_template, cookie_file=cookie_file,
+                                      blocked_resources=blocked_resources, browser_address=browser_address)
+        # 所有 HTTP 請求共用一個 Session，連接池至少能容納分段下載的並行連接
+        # 請求速率限制，見 DEFAULT_RATE_LIMITS
+        self.rate_limiter = RateLimiter(**dict(DEFAULT_RATE_LIMITS, **(rate_limits or {})))
+        self.session = create_http_session(pool_maxsize=pool_maxsize or max(DEFAULT_POOL_MAXSIZE, segments + 1),
+                                           limiter=self.rate_limiter)
+        # 按主機記錄鏡像的延遲和吞吐量
+        self.mirrors = MirrorSelector(self.session)
+        # 所有並行下載共用的進度輸出，按固定頻率刷新
+        self.progress = ProgressReporter()
         self.setup_session()
         self.load_cookies()
         self.create_download_folder()
+        # 已下載視頻清單，默認保存在下載資料夾中
+        self.manifest = DownloadManifest(manifest_path or os.path.join(self.download_folder, MANIFEST_FILENAME))
+        # 作品列表頁面緩存，有效期內重試或重新運行不需要再啟動瀏覽器
+        self.feed_cache = FeedCache(os.path.join(self.download_folder, FEED_CACHE_DIRNAME),
+                                    ttl=feed_cache_ttl, max_bytes=feed_cache_max_bytes)
     
-    def get_video_list_with_browser(self, user_url):
+    def get_video_list_with_browser(self, user_url, idle_timeout=None, incremental=False):
         """使用瀏覽器獲取視頻列表"""
-        user_data_dir = None
+        aweme_list = list(self.iter_aweme_with_browser(user_url, idle_timeout=idle_timeout, incremental=incremental))
+        if not aweme_list:
+            logger.warning(f"未找到包含aweme_list的響應")
+            return None
+        logger.info(f"成功獲取 {len(aweme_list)} 個視頻")
+        return aweme_list
+
+    def iter_aweme_with_browser(self, user_url, idle_timeout=None, incremental=False):
+        """使用瀏覽器邊滾動邊 yield aweme 項目，下游可以在列表加載完之前開始處理
+
+        incremental 為 True 時只返回上次同步之後的新作品，到達已知作品即停止滾動。
+        不更新同步位置，下載完成後由調用方用 advance_sync_state 推進。
+        """
+        page = None
+        sec_user_id = self.extract_sec_user_id(user_url)
+        since_create_time = None
+        if incremental and sec_user_id:
+            last_aweme_id, since_create_time = self.manifest.get_last_seen(sec_user_id)
+            if since_create_time:
+                logger.info(f"增量同步: 上次同步到 {last_aweme_id}")
+
+        cached = self.feed_cache.load_feed(sec_user_id, since_create_time) if sec_user_id else None
+        if cached is not None:
+            logger.info(f"使用緩存的作品列表: {len(cached)} 個視頻")
+            yield from cached
+            return
+
         try:
-            print("啟動瀏覽器...")
-            co = ChromiumOptions()
-
-            # 改為 WSL2 上安裝的 Linux chromium
-            chrome_path = '/usr/bin/google-chrome'
-            co.set_browser_path(chrome_path)
-
-            # 必要參數
-            co.set_argument('--no-sandbox')
-            co.set_argument('--disable-dev-shm-usage')
-            # co.set_argument('--disable-gpu')
-            co.set_argument('--disable-web-security')
-            co.set_argument('--disable-features=VizDisplayCompositor')
-            co.set_argument('--disable-extensions')
-            co.set_argument('--disable-plugins')
-            co.set_argument('--disable-images')
-            # 這兩行新增：
-            co.set_argument('--disable-setuid-sandbox')
-            co.set_argument('--remote-debugging-address=0.0.0.0')
-            co.set_argument('--headless=new')
-
-            # 設置用戶數據目錄避免衝突
-            user_data_dir = tempfile.mkdtemp()
-            co.set_user_data_path(user_data_dir)
-
-            # 自動選擇一個空閒端口並啟用 remote debugging
-            co.auto_port(9222)
-            co.set_argument(f'--remote-debugging-port={9222}')
-
-            print("正在啟動Chrome瀏覽器...")
-            page = ChromiumPage(addr_or_opts=co)
+            logger.info("啟動瀏覽器...")
+            page = self.browser.get_page()
             
-            # 訪問用戶頁面
-            print("訪問用戶頁面...")
-            page.get(user_url)
-            time.sleep(5)  # 等待頁面加載
+            # 在打開頁面前開始監聽作品列表接口，避免漏掉第一頁
+            logger.info("開始監聽網絡請求...")
+            page.listen.start(POST_API_PATTERN, res_type=POST_API_RES_TYPES)
             
-            # 開始監聽所有網絡請求
-            print("開始監聽網絡請求...")
-            page.listen.start()
+            # 訪問用戶頁面
+            logger.info("訪問用戶頁面...")
+            with self.metrics.stage('page_load', url=user_url):
+                page.get(user_url, timeout=self.timeouts['page_load'])
             
             # 檢查新的登入介面
-            login_panel = page.ele('#douyin-login-new-id')
-            if login_panel:
-                print("發現登入介面，關閉它...")
-                # 點擊對應的關閉按鈕 (svg rect)
-                close_btn = page.ele('rect[fill="url(#pattern0_3645_22461)"]')
-                if close_btn:
-                    close_btn.click()
-                    time.sleep(2)
-                else:
-                    print("未找到關閉按鈕")
-
-            # 滾動頁面以觸發視頻列表的加載
-            print("滾動頁面觸發請求...")
-            for i in range(5):  # 增加滾動次數
-                page.scroll.to_bottom()
-                time.sleep(2)
-                print(f"滾動 {i+1}/5...")
-            
-            # 等待並獲取包含aweme的請求
-            print("等待API響應...")
-            timeout = 30
-            start_time = time.time()
-            found_responses = []
-            
-            while time.time() - start_time < timeout:
-                # 獲取所有響應
-                responses = page.listen.steps()
-                
-                for response in responses:
-                    if response.url and 'aweme' in response.url:
-                        found_responses.append(response.url)
-                        print(f"找到響應: {response.url[:100]}...")
-                        
-                        if 'post' in response.url or True:
-                            print(f"找到aweme API請求: {response.url[:100]}...")
-                            try:
-                                data = response.response.body
-                                if data:
-                                    # 嘗試解析為JSON
-                                    if isinstance(data, str):
-                                        text = page.listen.response_text(response, timeout=5)
-                                        json_data = json.loads(text)
-                                    else:
-                                        json_data = data
-                                    
-                                    if 'aweme_list' in json_data:
-                                        print(f"成功獲取 {len(json_data['aweme_list'])} 個視頻")
-                                        return json_data['aweme_list']
-                            except Exception as e:
-                                print(f"解析響應失敗: {e}")
-                                continue
-                
-                time.sleep(1)
-            
-            print(f"未找到包含aweme_list的響應")
-            print(f"找到的響應: {found_responses}")
-            return None
+            with self.metrics.stage('close_popups'):
+                self.close_login_panel(page)
+
+            # 滾動頁面直到作品列表加載完畢（下游邊讀邊處理時包含下游的處理時間）
+            logger.info("滾動頁面觸發請求...")
+            items = iter_post_feed(page, idle_timeout=idle_timeout or self.timeouts['feed_idle'],
+                                   since_create_time=since_create_time, cache=self.feed_cache, sec_user_id=sec_user_id)
+            with self.metrics.stage('scroll_feed', sec_user_id=sec_user_id):
+                yield from items
                 
         except Exception as e:
-            print(f"瀏覽器獲取數據失敗: {e}")
-            import traceback
-            traceback.print_exc()
-            return None
+            logger.exception(f"瀏覽器獲取數據失敗: {e}")
         finally:
+            # 只停止監聽，瀏覽器留給下一次使用
             try:
-                page.quit()
+                page.listen.stop()
             except:
                 pass
-            # 清理臨時目錄
-            if user_data_dir:
-                try:
-                    shutil.rmtree(user_data_dir, ignore_errors=True)
-                except:
-                    pass
+
+    def close_login_panel(self, page):
+        """等待登入介面出現並關閉，不出現時最多等待 login_panel 秒"""
+        login_panel = page.ele('#douyin-login-new-id', timeout=self.timeouts['login_panel'])
+        if not login_panel:
+            return
+        logger.info("發現登入介面，關閉它...")
+        # 點擊對應的關閉按鈕 (svg rect)
+        close_btn = page.ele('rect[fill="url(#pattern0_3645_22461)"]', timeout=self.timeouts['popup_close'])
+        if close_btn:
+            close_btn.click()
+            # 等待登入介面消失，而不是固定等待
+            login_panel.wait.hidden(timeout=self.timeouts['popup_close'])
+        else:
+            logger.debug("未找到關閉按鈕")
+
+    def close(self):
+        """關閉共用的瀏覽器和下載清單，寫出最終的指標"""
+        self.browser.quit()
+        self.manifest.close()
+        self.metrics.close()
+        self.progress.close()
 
     def create_download_folder(self):
         """創建下載資料夾"""
         if not os.path.exists(self.download_folder):
             os.makedirs(self.download_folder)
-            print(f"已創建下載資料夾: {self.download_folder}")
+            logger.info(f"已創建下載資料夾: {self.download_folder}")
     
 
     def setup_session(self):
@@ -160,18 +1832,19 @@ class DouyinVideoDownloader:
             'Sec-Fetch-Dest': 'empty',
             'Sec-Fetch-Mode': 'cors',
             'Sec-Fetch-Site': 'same-origin',
+            'sec-ch-ua': '"Not_A Brand";v="8", "Chromium";v="138", "Google Chrome";v="138"',
+            'sec-ch-ua-mobile': '?0',
+            'sec-ch-ua-platform': '"Windows"',
         })
     
     def load_cookies(self):
-        """從 cookies.json 文件載入 cookies"""
+        """從 cookies 文件（JSON 或 Netscape 格式）載入 cookies"""
         if not os.path.exists(self.cookie_file):
-            print(f"未找到 cookies 文件: {self.cookie_file}")
+            logger.warning(f"未找到 cookies 文件: {self.cookie_file}")
             return
         
         try:
-            # 讀取 JSON 格式的 cookies 文件
-            with open(self.cookie_file, 'r', encoding='utf-8') as f:
-                cookies_list = json.load(f)
+            cookies_list = read_cookie_file(self.cookie_file)
             
             cookies_count = 0
             for cookie in cookies_list:
@@ -185,145 +1858,74 @@ class DouyinVideoDownloader:
                         cookies_count += 1
                         
                 except Exception as cookie_error:
-                    print(f"設置單個 cookie 失敗: {cookie.get('name', 'unknown')}, 錯誤: {cookie_error}")
+                    logger.debug(f"設置單個 cookie 失敗: {cookie.get('name', 'unknown')}, 錯誤: {cookie_error}")
                     continue
             
-            print(f"成功載入 {cookies_count} 個 cookies")
+            logger.info(f"成功載入 {cookies_count} 個 cookies")
             
         except Exception as e:
-            print(f"載入 cookies 失敗: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"載入 cookies 失敗: {e}")
     
     def load_cookies_to_browser(self, page):
-        """將 cookies 載入到瀏覽器"""
-        if not os.path.exists(self.cookies_file):
-            return
-        
+        """將 cookies 載入到瀏覽器（BrowserManager 啟動時已自動載入，這裡用於手動重新載入）"""
         try:
-            # 先訪問抖音主頁以設置域名
-            page.get('https://www.douyin.com')
-            time.sleep(2)
-            
-            # 讀取 JSON 格式的 cookies 文件
-            with open(self.cookies_file, 'r', encoding='utf-8') as f:
-                cookies_list = json.load(f)
-            
-            cookies_count = 0
-            for cookie in cookies_list:
-                try:
-                    # 構建 cookie 字典，只使用必要的字段
-                    cookie_dict = {
-                        'name': cookie.get('name'),
-                        'value': cookie.get('value'),
-                        'domain': cookie.get('domain', '.douyin.com'),
-                        'path': cookie.get('path', '/'),
-                        'secure': cookie.get('secure', False),
-                        'httpOnly': cookie.get('httpOnly', False)
-                    }
-                    
-                    # 過濾掉無效的 cookies
-                    if cookie_dict['name'] and cookie_dict['value']:
-                        page.set.cookies(cookie_dict)
-                        cookies_count += 1
-                        
-                except Exception as cookie_error:
-                    print(f"設置單個 cookie 失敗: {cookie.get('name', 'unknown')}, 錯誤: {cookie_error}")
-                    continue
-            
-            print(f"成功載入 {cookies_count} 個 cookies 到瀏覽器")
-            
+            cookies_count = inject_cookies(page, read_cookie_file(self.cookie_file))
+            logger.info(f"成功載入 {cookies_count} 個 cookies 到瀏覽器")
         except Exception as e:
-            print(f"載入 cookies 到瀏覽器失敗: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"載入 cookies 到瀏覽器失敗: {e}")
+
+    def fetch_post_page(self, api_url):
+        """請求作品列表接口的一頁，返回解析後的 JSON，失敗時拋出 PostApiError 或 requests 的異常"""
+        # cookies 和請求頭已在 setup_session / load_cookies 中設置
+        with self.metrics.stage('api_fetch', url=api_url):
+            return fetch_post_page(self.session, api_url)
 
     def fetch_video_list(self, api_url):
-        """使用API獲取視頻列表"""
+        """使用API獲取一頁視頻列表，失敗時返回 None；按 sec_user_id 分頁獲取全部作品見 iter_post_api"""
+        logger.info("正在獲取視頻列表...")
         try:
-            print("正在獲取視頻列表...")
-            
-            # 添加必要的cookies和headers
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36',
-                'Accept': 'application/json, text/plain, */*',
-                'Accept-Language': 'zh-TW,zh;q=0.9,en;q=0.8',
-                'Accept-Encoding': 'gzip, deflate, br',
-                'Connection': 'keep-alive',
-                'Referer': 'https://www.douyin.com/',
-                'Sec-Fetch-Dest': 'empty',
-                'Sec-Fetch-Mode': 'cors',
-                'Sec-Fetch-Site': 'same-origin',
-                'sec-ch-ua': '"Not_A Brand";v="8", "Chromium";v="138", "Google Chrome";v="138"',
-                'sec-ch-ua-mobile': '?0',
-                'sec-ch-ua-platform': '"Windows"',
-            }
-            
-            response = self.session.get(api_url, headers=headers)
-            
-            print(f"HTTP狀態碼: {response.status_code}")
-            print(f"響應頭: {dict(response.headers)}")
-            print(f"響應內容前500字符: {response.text[:500]}")
-            
-            if response.status_code == 200:
-                if response.text.strip():
-                    try:
-                        data = response.json()
-                        if 'aweme_list' in data:
-                            print(f"成功獲取 {len(data['aweme_list'])} 個視頻")
-                            return data['aweme_list']
-                        else:
-                            print("響應中未找到aweme_list")
-                            print(f"可用的鍵: {list(data.keys()) if isinstance(data, dict) else 'Not a dict'}")
-                            return None
-                    except json.JSONDecodeError as e:
-                        print(f"JSON解析失敗: {e}")
-                        print(f"響應內容: {response.text}")
-                        return None
-                else:
-                    print("響應為空")
-                    return None
-            else:
-                print(f"請求失敗，狀態碼: {response.status_code}")
-                print(f"響應內容: {response.text}")
-                return None
-                
-        except Exception as e:
-            print(f"獲取視頻列表失敗: {e}")
-            import traceback
-            traceback.print_exc()
+            data = self.fetch_post_page(api_url)
+        except (PostApiError, requests.RequestException) as e:
+            logger.warning(f"獲取視頻列表失敗: {e}")
             return None
+        logger.info(f"成功獲取 {len(data['aweme_list'])} 個視頻")
+        return data['aweme_list']
     
-    def download_video(self, video_url, filename):
-        """下載視頻"""
+    def download_video(self, video_urls, filename):
+        """下載視頻，video_urls 為同一個視頻的鏡像地址列表（也可以是單個地址）
+
+        按 self.mirrors 的排序嘗試各個鏡像，出錯或速度過慢時切換。地址過期時拋出 URLExpiredError。
+        """
+        if isinstance(video_urls, str):
+            video_urls = [video_urls]
+        retries = []
+        start = time.perf_counter()
         try:
-            print(f"正在下載: {filename}")
-            
-            # 設置下載用的請求頭
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36',
-                'Referer': 'https://www.douyin.com/',
-            }
-            
-            response = requests.get(video_url, headers=headers, stream=True)
-            
-            if response.status_code == 200:
-                filepath = os.path.join(self.download_folder, filename)
-                
-                with open(filepath, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-                
-                print(f"✓ 下載完成: {filename}")
-                return True
-            else:
-                print(f"✗ 下載失敗: {filename}, 狀態碼: {response.status_code}")
-                return False
-                
+            logger.info(f"正在下載: {filename}")
+            filepath = os.path.join(self.download_folder, filename)
+            size = download_from_mirrors(self.mirrors, video_urls,
+                                         lambda url, progress: fetch_video(self.session, url, filepath, self.segments, progress),
+                                         on_retry=lambda url, e: retries.append(e),
+                                         progress=self.progress.callback(filename))
+            self.metrics.record_download(filename, size, time.perf_counter() - start, len(retries))
+            downloaded, rate = self.progress.finish(filename)
+            logger.info(f"✓ 下載完成: {filename} ({format_bytes(downloaded)}, {format_bytes(rate)}/s)")
+            return True
+        
+        except requests.HTTPError as e:
+            if is_url_expired(e):
+                self.metrics.record_download(filename, 0, time.perf_counter() - start, len(retries), 'expired', e)
+                logger.warning(f"✗ 鏈接已過期: {filename}, 狀態碼: {e.response.status_code}")
+                raise URLExpiredError(video_urls[0]) from e
+            self.metrics.record_download(filename, 0, time.perf_counter() - start, len(retries), 'failed', e)
+            logger.error(f"✗ 下載失敗: {filename}, 錯誤: {e}")
+            return False
         except Exception as e:
-            print(f"✗ 下載失敗: {filename}, 錯誤: {e}")
+            self.metrics.record_download(filename, 0, time.perf_counter() - start, len(retries), 'failed', e)
+            logger.error(f"✗ 下載失敗: {filename}, 錯誤: {e}")
             return False
+        finally:
+            self.progress.finish(filename)
     def extract_sec_user_id(self, user_url):
         """從用戶頁面URL提取sec_user_id"""
         try:
@@ -333,10 +1935,10 @@ class DouyinVideoDownloader:
                 return match.group(1)
             return None
         except Exception as e:
-            print(f"提取sec_user_id失敗: {e}")
+            logger.warning(f"提取sec_user_id失敗: {e}")
             return None
 
-    def get_video_page_urls(self, page: ChromiumPage):
+    def get_video_page_urls(self, page: 'ChromiumPage'):
         """從當前頁面提取所有影片頁面網址"""
         container_xpath = "/html/body/div[2]/div[1]/div[4]/div[2]/div/div/div/div[3]/div/div/div[2]/div/div[2]"
         links = page.eles(f"xpath:{container_xpath}//a[@href]")
@@ -351,37 +1953,35 @@ class DouyinVideoDownloader:
                 urls.append(href)
         return urls
 
-    def fetch_mp4_from_page(self, page: ChromiumPage, video_page_url: str):
+    def fetch_mp4_from_page(self, page: 'ChromiumPage', video_page_url: str):
         """在影片頁面監聽並返回所有 mp4 連結"""
-        page.listen.start()
-        page.get(video_page_url)
-        time.sleep(5)
-
-        # 收集所有抓到的封包
-        packets = list(page.listen.steps(timeout=5))
-        page.listen.stop()
-
-        mp4_urls = []
-        for packet in packets:
-            url = getattr(packet, "url", "")
-            if not url:
-                continue
-
-            # 先依據 header 中的 content-type 判斷
-            ctype = ""
-            try:
-                if packet.response and packet.response.headers:
-                    ctype = packet.response.headers.get("Content-Type", "")
-            except Exception:
-                pass
+        # 只記錄視頻資源的響應頭，不緩存頁面的其他請求和視頻內容
+        capture = MediaCapture(page)
+        capture.start()
+        try:
+            with self.metrics.stage('page_load', url=video_page_url):
+                page.get(video_page_url, timeout=self.timeouts['page_load'])
 
-            if "video/mp4" in ctype or "video" in url.lower() and '.js' not in url.lower() and '.css' not in url.lower():
-                mp4_urls.append(url)
+            # 等待第一個視頻請求出現，之後只再收集 media_settle 秒內的其他清晰度
+            mp4_urls = []
+            deadline = time.time() + self.timeouts['media']
+            with self.metrics.stage('media_capture', url=video_page_url):
+                while True:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    url = capture.wait(remaining)
+                    if not url:
+                        break
+                    mp4_urls.append(url)
+                    deadline = min(deadline, time.time() + self.timeouts['media_settle'])
+        finally:
+            capture.stop()
 
         # 去除重複並保持順序
         unique_urls = list(dict.fromkeys(mp4_urls))
         return unique_urls
-    def get_video_page_urls(self, page: ChromiumPage):
+    def get_video_page_urls(self, page: 'ChromiumPage'):
         """從當前頁面提取所有影片頁面網址"""
         container_xpath = "/html/body/div[2]/div[1]/div[4]/div[2]/div/div/div/div[3]/div/div/div[2]/div/div[2]"
         links = page.eles(f"xpath:{container_xpath}//a[@href]")
@@ -397,102 +1997,151 @@ class DouyinVideoDownloader:
         return urls
 
 
-    def run(self, user_url, api_url=None):
-        """主要運行函數"""
-        print("=== 抖音視頻下載器 ===")
-        print(f"用戶頁面: {user_url}")
+    def select_best_candidate(self, candidates):
+        """探測 (url, 文件名) 候選列表，返回 video 類型中最大的一個，全部失敗時返回 None"""
+        ranked = []
+        for link, name in candidates:
+            try:
+                result = probe_video_candidate(self.session, link, DOWNLOAD_HEADERS)
+            except Exception as e:
+                logger.debug(f"探測失敗: {name}, 錯誤: {e}")
+                continue
+            if not result:
+                logger.debug(f"探測失敗: {name}")
+                continue
+            size, content_type = result
+            logger.debug(f"候選: {name}, size: {size}, type: {content_type}")
+            # 先比較是否為視頻類型，再比較大小
+            ranked.append((content_type.startswith('video/'), size, link, name))
+
+        if not ranked:
+            return None
+        ranked.sort(key=lambda r: (r[0], r[1]), reverse=True)
+        is_video, size, link, name = ranked[0]
+        logger.debug(f"biggest: {name} ({size} bytes)")
+        return link, name
+
+    def download_video_page(self, page, vp, sec_user_id=None):
+        """打開一個視頻頁面並下載其中最好的視頻資源，成功後記錄到下載清單
+
+        地址已過期時拋出 URLExpiredError，由調用方重新打開頁面後重試。
+        """
+        logger.debug(f"打開: {vp}")
+        aweme_id = extract_aweme_id(vp)
+        mp4s = self.fetch_mp4_from_page(page, vp)
+        if not mp4s:
+            logger.warning("未找到影片資源")
+            return False
+        candidates = []
+        for link in mp4s:
+            name = os.path.basename(urlparse(link).path)
+            if name == '' or name == None or not name: 
+                import random 
+                name = str(random.randint(100000000000000, 99999999999999999)) + '.mp4'
+            if not name.endswith('.mp4') or 'uuu' in name:
+                continue
+            # 能從頁面網址得到 aweme_id 時用它命名，重複運行時文件名保持一致
+            if aweme_id:
+                name = f"{aweme_id}.mp4"
+            candidates.append((link, name))
+
+        # 只下載探測結果最好的一個，不再全部下載後刪除
+        with self.metrics.stage('probe_candidates', url=vp):
+            best = self.select_best_candidate(candidates)
+        if not best:
+            logger.warning("沒有可下載的影片資源")
+            return False
+        link, name = best
+        if not self.download_video(link, name):
+            return False
+        if aweme_id:
+            self.manifest.record(aweme_id, os.path.join(self.download_folder, name), sec_user_id=sec_user_id)
+        return True
+
+    def run(self, user_url, api_url=None, incremental=False):
+        """主要運行函數，incremental 為 True 時只處理上次同步之後的新作品"""
+        logger.info("=== 抖音視頻下載器 ===")
+        logger.info(f"用戶頁面: {user_url}")
 
-        user_data_dir = None
         page = None
-        try:
-            co = ChromiumOptions()
-            chrome_path = '/usr/bin/google-chrome'
-            co.set_browser_path(chrome_path)
-            co.set_argument('--no-sandbox')
-            co.set_argument('--disable-dev-shm-usage')
-            co.set_argument('--disable-web-security')
-            co.set_argument('--disable-features=VizDisplayCompositor')
-            co.set_argument('--disable-extensions')
-            co.set_argument('--disable-plugins')
-            co.set_argument('--disable-images')
-            co.set_argument('--disable-setuid-sandbox')
-            co.set_argument('--remote-debugging-address=0.0.0.0')
-            co.set_argument('--headless=new')
-
-            user_data_dir = tempfile.mkdtemp()
-            co.set_user_data_path(user_data_dir)
-            co.auto_port(9222)
-            co.set_argument(f'--remote-debugging-port={9222}')
-
-            print("正在啟動Chrome瀏覽器...")
-            page = ChromiumPage(addr_or_opts=co)
-
-            print("訪問用戶頁面...")
-            page.get(user_url)
-            time.sleep(5)
-
-            login_panel = page.ele('#douyin-login-new-id')
-            if login_panel:
-                close_btn = page.ele('rect[fill="url(#pattern0_3645_22461)"]')
-                if close_btn:
-                    close_btn.click()
-                    time.sleep(2)
-            import tqdm
-            for _ in tqdm.tqdm(range(5)):
-                page.scroll.to_bottom()
-                time.sleep(2)
-
-            video_pages = self.get_video_page_urls(page)
-            print(f"找到 {len(video_pages)} 個影片頁面")
-
-            for vp in video_pages:
-                print(f"打開: {vp}")
-                mp4s = self.fetch_mp4_from_page(page, vp)
-                if not mp4s:
-                    print("未找到影片資源")
-                    continue
-                sizes = []
-                for link in mp4s:
-                    name = os.path.basename(urlparse(link).path)
-                    if name == '' or name == None or not name: 
-                        import random 
-                        name = str(random.randint(100000000000000, 99999999999999999)) + '.mp4'
-                    if not name.endswith('.mp4') or 'uuu' in name:
-                        continue
-                    size = self.download_video(link, name)
-                    sizes.append((size, name))
-                    print(f"size: {size}")
-                    time.sleep(1)
-                       
-                sorted(sizes, key=lambda s: s[0]) # use size to sort
-                print(f'biggest: {sizes[0]}')
-                sizes.pop(0)
-                for (size , name) in sizes:
-                    if os.path.exists('douyin_videos/'+ name):
-                        os.remove(os.path.join('douyin_videos', name))
-
-                sizes = []
+        with self.metrics.stage('run', user_url=user_url):
+            try:
+                page = self.browser.get_page()
+
+                page.listen.start(POST_API_PATTERN, res_type=POST_API_RES_TYPES)
+
+                logger.info("訪問用戶頁面...")
+                with self.metrics.stage('page_load', url=user_url):
+                    page.get(user_url, timeout=self.timeouts['page_load'])
+
+                with self.metrics.stage('close_popups'):
+                    self.close_login_panel(page)
+
+                sec_user_id = self.extract_sec_user_id(user_url)
+                since_create_time = None
+                if incremental and sec_user_id:
+                    last_aweme_id, since_create_time = self.manifest.get_last_seen(sec_user_id)
+
+                # 滾動直到作品列表接口返回 has_more 為 0、沒有新的視頻或到達上次同步的位置
+                items = iter_post_feed(page, idle_timeout=self.timeouts['feed_idle'], since_create_time=since_create_time,
+                                       cache=self.feed_cache, sec_user_id=sec_user_id)
+                with self.metrics.stage('scroll_feed', sec_user_id=sec_user_id):
+                    feed = list(items)
+                page.listen.stop()
+
+                video_pages = self.get_video_page_urls(page)
+                logger.info(f"找到 {len(video_pages)} 個影片頁面")
+
+                # 打開影片頁面前先批量查詢下載清單，跳過已下載的視頻
+                known = self.manifest.known_ids(extract_aweme_id(vp) for vp in video_pages)
+                if known:
+                    logger.info(f"跳過 {len(known)} 個已下載的視頻")
+                video_pages = [vp for vp in video_pages if extract_aweme_id(vp) not in known]
+
+                # 排在後面的視頻打開頁面時拿到的地址可能已過期，這些頁面最後統一重新打開一次
+                expired_pages = []
+                for vp in video_pages:
+                    try:
+                        if not self.download_video_page(page, vp, sec_user_id):
+                            self.manifest.record_failure(extract_aweme_id(vp), sec_user_id)
+                    except URLExpiredError:
+                        expired_pages.append(vp)
+
+                if expired_pages:
+                    logger.warning(f"{len(expired_pages)} 個視頻的鏈接已過期，重新打開頁面獲取...")
+                    for vp in expired_pages:
+                        try:
+                            if self.download_video_page(page, vp, sec_user_id):
+                                continue
+                        except URLExpiredError:
+                            logger.warning(f"✗ 重新獲取後鏈接仍然過期: {vp}")
+                        self.manifest.record_failure(extract_aweme_id(vp), sec_user_id)
+
+                # 同步位置只推進到已下載的作品
+                advance_sync_state(self.manifest, sec_user_id, feed)
         
-        except Exception as e:
-            print(f"瀏覽器操作失敗: {e}")
-            import traceback
-            traceback.print_exc()
-        finally:
-            if page:
-                try:
-                    page.quit()
-                except Exception:
-                    pass
-            if user_data_dir:
-                shutil.rmtree(user_data_dir, ignore_errors=True)                
+            except Exception as e:
+                logger.exception(f"瀏覽器操作失敗: {e}")
+            finally:
+                # 只停止監聽，瀏覽器留給下一次 run() 使用
+                if page:
+                    try:
+                        page.listen.stop()
+                    except Exception:
+                        pass
+        self.metrics.write_prometheus()
 def main():
+    setup_logging()
     # 用戶URL
     user_url = "https://www.douyin.com/user/MS4wLjABAAAA4UAJ57hn-vBHuN-OF1D5fv66HG7QSEC9KcGE5UKO0McCgah4U6hqVNPZZUpN7YsW?from_tab_name=main"
     # 創建下載器實例
     downloader = DouyinVideoDownloader()
     
-    # 運行下載器
-    downloader.run(user_url)
+    try:
+        # 運行下載器
+        downloader.run(user_url)
+    finally:
+        downloader.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -3,20 +3,121 @@ import json
 import os
 from urllib.parse import urlparse
 import time
-from DrissionPage import ChromiumPage, ChromiumOptions
 import re
-import tempfile
-import shutil
-from http.cookiejar import MozillaCookieJar
+import logging
+import sys
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from douyin_downloader import (DEFAULT_POOL_MAXSIZE, DEFAULT_RATE_LIMITS, DOWNLOAD_HEADERS, POST_API_PATTERN,
+                               POST_API_RES_TYPES, DEFAULT_TIMEOUTS, MANIFEST_FILENAME, FEED_CACHE_DIRNAME,
+                               FEED_CACHE_TTL, FEED_CACHE_MAX_BYTES, DISCOVERY_BLOCKED_RESOURCES,
+                               BrowserManager, DownloadManifest, FeedCache, MediaCapture, Metrics,
+                               MirrorSelector, PostApiError, ProgressReporter, download_from_mirrors,
+                               fetch_video, RateLimiter, URLExpiredError, create_http_session, is_url_expired,
+                               iter_post_feed, iter_post_api, fetch_post_page, advance_sync_state,
+                               extract_aweme_id, resolve_aweme_details, inject_cookies, read_cookie_file,
+                               format_bytes, setup_logging)
+
+logger = logging.getLogger(__name__)
+
+# extract_video_info 可選的清晰度策略：
+#   play_addr - 使用默認的 play_addr（原本的行為）
+#   highest   - 碼率最高的版本
+#   smallest  - 文件最小的版本
+#   720p      - 短邊不超過 720 的版本中碼率最高的
+#   h264      - 優先 h264，沒有時再用 h265 中碼率最高的
+VARIANT_POLICIES = ('play_addr', 'highest', 'smallest', '720p', 'h264')
+
+# 懸停預覽需要正常的佈局和封面圖片，默認只屏蔽字體和統計請求；發現用的標籤頁使用 DISCOVERY_BLOCKED_RESOURCES
+BROWSER_BLOCKED_RESOURCES = ('font', 'analytics')
+
+
+class FairJobQueue:
+    """按用戶輪流取出任務的隊列，避免一個大賬號佔滿所有下載線程"""
+    
+    def __init__(self):
+        self._queues = OrderedDict()
+        self._cond = threading.Condition()
+        self._closed = False
+    
+    def put(self, key, job):
+        """加入某個用戶的下載任務"""
+        with self._cond:
+            self._queues.setdefault(key, deque()).append(job)
+            self._cond.notify()
+    
+    def close(self):
+        """不再加入新任務，取完後 get() 返回 None"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+    
+    def get(self):
+        """輪流從各用戶的隊列中取出 (key, job)，隊列已關閉且為空時返回 None"""
+        with self._cond:
+            while True:
+                for key, jobs in self._queues.items():
+                    if jobs:
+                        job = jobs.popleft()
+                        # 取過的用戶移到最後，下一次優先其他用戶
+                        self._queues.move_to_end(key)
+                        return key, job
+                if self._closed:
+                    return None
+                self._cond.wait()
+
 
 class DouyinVideoDownloader:
-    def __init__(self, download_folder="douyin_videos", cookies_file="cookies.json"):
+    def __init__(self, download_folder="douyin_videos", cookies_file="cookies.json", max_workers=4, per_host_limit=2, segments=1, variant_policy='play_addr', timeouts=None,
+                 manifest_path=None, feed_cache_ttl=FEED_CACHE_TTL, feed_cache_max_bytes=FEED_CACHE_MAX_BYTES,
+                 pool_maxsize=None, rate_limits=None, metrics_jsonl=None, metrics_prom=None, profile_template=None,
+                 blocked_resources=BROWSER_BLOCKED_RESOURCES, browser_address=None):
         self.download_folder = download_folder
+        # 各階段耗時和下載結果，可寫出為 JSON lines 和 Prometheus textfile
+        self.metrics = Metrics(metrics_jsonl, metrics_prom)
         self.cookies_file = cookies_file
-        self.session = requests.Session()
+        # 並行下載設置：max_workers 為 1 時使用原本的逐個下載
+        self.max_workers = max_workers
+        self.per_host_limit = per_host_limit
+        self._host_semaphores = {}
+        self._host_lock = threading.Lock()
+        # 下載時地址已過期的視頻 {aweme_id: (sec_user_id, 文件名)}，一輪下載結束後統一重新獲取地址並重試
+        self._expired = {}
+        self._expired_lock = threading.Lock()
+        # 單個視頻的分段並行下載數，1 表示使用單個連接
+        self.segments = segments
+        if variant_policy not in VARIANT_POLICIES:
+            raise ValueError(f"未知的清晰度策略: {variant_policy}，可選: {', '.join(VARIANT_POLICIES)}")
+        self.variant_policy = variant_policy
+        # 瀏覽器各步驟的等待上限，見 DEFAULT_TIMEOUTS
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        # 多次 run() 共用同一個瀏覽器（保留圖片加載），使用完畢後調用 close() 關閉
+        # 啟動時從 profile_template 複製預熱的用戶數據，屏蔽 blocked_resources 中的請求並載入 cookies；
+        # 傳入 browser_address（host:port）時連接已在運行的瀏覽器，多個進程共用
+        self.browser = BrowserManager(disable_images=False, metrics=self.metrics, profile_template=profile_template,
+                                      cookie_file=cookies_file, blocked_resources=blocked_resources,
+                                      browser_address=browser_address)
+        # 所有 HTTP 請求共用一個 Session。同一主機最多 per_host_limit 個任務，每個任務最多 segments 個連接，
+        # 再加上探測請求；連接池隨並行數擴大，避免多出來的連接用完即棄
+        host_concurrency = max(per_host_limit, 1) * (max(segments, 1) + 1)
+        # 請求速率限制，取代原本每個下載之後的固定延遲，見 DEFAULT_RATE_LIMITS
+        self.rate_limiter = RateLimiter(**dict(DEFAULT_RATE_LIMITS, **(rate_limits or {})))
+        self.session = create_http_session(pool_maxsize=pool_maxsize or max(DEFAULT_POOL_MAXSIZE, host_concurrency),
+                                           pool_connections=max(DEFAULT_POOL_MAXSIZE, max_workers),
+                                           limiter=self.rate_limiter)
+        # 按主機記錄鏡像的延遲和吞吐量，後面的視頻優先使用健康、快速的主機
+        self.mirrors = MirrorSelector(self.session)
+        # 所有並行下載共用的進度輸出，按固定頻率刷新
+        self.progress = ProgressReporter()
         self.setup_session()
         self.load_cookies()
         self.create_download_folder()
+        # 已下載視頻清單，默認保存在下載資料夾中
+        self.manifest = DownloadManifest(manifest_path or os.path.join(self.download_folder, MANIFEST_FILENAME))
+        # 作品列表頁面緩存，有效期內重試或重新運行不需要再啟動瀏覽器
+        self.feed_cache = FeedCache(os.path.join(self.download_folder, FEED_CACHE_DIRNAME),
+                                    ttl=feed_cache_ttl, max_bytes=feed_cache_max_bytes)
         
     def setup_session(self):
         """設置請求頭"""
@@ -30,18 +131,19 @@ class DouyinVideoDownloader:
             'Sec-Fetch-Dest': 'empty',
             'Sec-Fetch-Mode': 'cors',
             'Sec-Fetch-Site': 'same-origin',
+            'sec-ch-ua': '"Not_A Brand";v="8", "Chromium";v="138", "Google Chrome";v="138"',
+            'sec-ch-ua-mobile': '?0',
+            'sec-ch-ua-platform': '"Windows"',
         })
     
     def load_cookies(self):
-        """從 cookies.json 文件載入 cookies"""
+        """從 cookies 文件（JSON 或 Netscape 格式）載入 cookies"""
         if not os.path.exists(self.cookies_file):
-            print(f"未找到 cookies 文件: {self.cookies_file}")
+            logger.warning(f"未找到 cookies 文件: {self.cookies_file}")
             return
         
         try:
-            # 讀取 JSON 格式的 cookies 文件
-            with open(self.cookies_file, 'r', encoding='utf-8') as f:
-                cookies_list = json.load(f)
+            cookies_list = read_cookie_file(self.cookies_file)
             
             cookies_count = 0
             for cookie in cookies_list:
@@ -55,100 +157,97 @@ class DouyinVideoDownloader:
                         cookies_count += 1
                         
                 except Exception as cookie_error:
-                    print(f"設置單個 cookie 失敗: {cookie.get('name', 'unknown')}, 錯誤: {cookie_error}")
+                    logger.debug(f"設置單個 cookie 失敗: {cookie.get('name', 'unknown')}, 錯誤: {cookie_error}")
                     continue
             
-            print(f"成功載入 {cookies_count} 個 cookies")
+            logger.info(f"成功載入 {cookies_count} 個 cookies")
             
         except Exception as e:
-            print(f"載入 cookies 失敗: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"載入 cookies 失敗: {e}")
     
     def load_cookies_to_browser(self, page):
-        """將 cookies 載入到瀏覽器"""
-        if not os.path.exists(self.cookies_file):
-            return
-        
+        """將 cookies 載入到瀏覽器（BrowserManager 啟動時已自動載入，這裡用於手動重新載入）"""
         try:
-            # 先訪問抖音主頁以設置域名
-            page.get('https://www.douyin.com')
-            time.sleep(2)
-            
-            # 讀取 JSON 格式的 cookies 文件
-            with open(self.cookies_file, 'r', encoding='utf-8') as f:
-                cookies_list = json.load(f)
-            
-            cookies_count = 0
-            for cookie in cookies_list:
-                try:
-                    # 構建 cookie 字典，只使用必要的字段
-                    cookie_dict = {
-                        'name': cookie.get('name'),
-                        'value': cookie.get('value'),
-                        'domain': cookie.get('domain', '.douyin.com'),
-                        'path': cookie.get('path', '/'),
-                        'secure': cookie.get('secure', False),
-                        'httpOnly': cookie.get('httpOnly', False)
-                    }
-                    
-                    # 過濾掉無效的 cookies
-                    if cookie_dict['name'] and cookie_dict['value']:
-                        page.set.cookies(cookie_dict)
-                        cookies_count += 1
-                        
-                except Exception as cookie_error:
-                    print(f"設置單個 cookie 失敗: {cookie.get('name', 'unknown')}, 錯誤: {cookie_error}")
-                    continue
-            
-            print(f"成功載入 {cookies_count} 個 cookies 到瀏覽器")
-            
+            cookies_count = inject_cookies(page, read_cookie_file(self.cookies_file))
+            logger.info(f"成功載入 {cookies_count} 個 cookies 到瀏覽器")
         except Exception as e:
-            print(f"載入 cookies 到瀏覽器失敗: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"載入 cookies 到瀏覽器失敗: {e}")
     
-    def close_popups(self, page):
-        """關閉各種彈窗"""
+    def close_popups(self, page, timeout=None):
+        """關閉各種彈窗
+        
+        timeout 為等待登入介面出現的時間，默認使用 login_panel；頁面已加載完時傳 0 只檢查當前狀態。
+        """
+        if timeout is None:
+            timeout = self.timeouts['login_panel']
         try:
             # 關閉登入彈窗
-            login_panel = page.ele('#douyin-login-new-id')
+            login_panel = page.ele('#douyin-login-new-id', timeout=timeout)
             if login_panel:
-                print("發現登入介面，關閉它...")
-                close_btn = page.ele('rect[fill="url(#pattern0_3645_22461)"]') or page.ele('.close') or page.ele('[aria-label="Close"]')
+                logger.info("發現登入介面，關閉它...")
+                close_btn = (page.ele('rect[fill="url(#pattern0_3645_22461)"]', timeout=self.timeouts['popup_close'])
+                             or page.ele('.close', timeout=0) or page.ele('[aria-label="Close"]', timeout=0))
                 if close_btn:
                     close_btn.click()
-                    time.sleep(1)
+                    login_panel.wait.hidden(timeout=self.timeouts['popup_close'])
                 else:
-                    print("未找到關閉按鈕")
+                    logger.debug("未找到關閉按鈕")
             
             # 關閉其他可能的彈窗或 alert
             try:
                 alert = page.handle_alert(accept=False, timeout=1)
                 if alert:
-                    print("關閉 alert 彈窗")
+                    logger.debug("關閉 alert 彈窗")
             except:
                 pass
             
             # 關閉通用的彈窗
-            close_buttons = page.eles('.close-btn') + page.eles('.modal-close') + page.eles('[data-testid="close"]')
+            close_buttons = page.eles('.close-btn', timeout=0) + page.eles('.modal-close', timeout=0) + page.eles('[data-testid="close"]', timeout=0)
             for btn in close_buttons:
                 try:
                     if btn.is_displayed():
                         btn.click()
-                        time.sleep(0.5)
-                        print("關閉彈窗")
+                        btn.wait.hidden(timeout=self.timeouts['popup_close'])
+                        logger.debug("關閉彈窗")
                 except:
                     continue
                     
         except Exception as e:
-            print(f"關閉彈窗時出錯: {e}")
+            logger.warning(f"關閉彈窗時出錯: {e}")
+    
+    def get_li_aweme_id(self, li):
+        """從視頻項目中的鏈接（/video/<aweme_id>）提取 aweme_id"""
+        try:
+            link = li.ele('tag:a', timeout=0)
+            return extract_aweme_id(link.attr('href')) if link else None
+        except Exception:
+            return None
+    
+    def is_video_url(self, url):
+        """判斷懸停時監聽到的請求是否為視頻地址"""
+        if not url or not any(domain in url for domain in ['zjcdn.com', 'bytedance.com', 'douyin.com']):
+            return False
+        return ('video' in url and url.endswith(('.mp4', '.mov'))) or 'mime_type=video_mp4' in url
+    
+    def wait_video_response(self, capture, responses, timeout):
+        """收集 capture 記錄到的視頻資源 URL 到 responses，出現視頻地址時立即返回 True，超時返回 False"""
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            url = capture.wait(remaining)
+            if not url:
+                return False
+            responses.append(url)
+            if self.is_video_url(url):
+                return True
     
     def create_download_folder(self):
         """創建下載資料夾"""
         if not os.path.exists(self.download_folder):
             os.makedirs(self.download_folder)
-            print(f"已創建下載資料夾: {self.download_folder}")
+            logger.info(f"已創建下載資料夾: {self.download_folder}")
     
     def extract_sec_user_id(self, user_url):
         """從用戶頁面URL提取sec_user_id"""
@@ -159,371 +258,389 @@ class DouyinVideoDownloader:
                 return match.group(1)
             return None
         except Exception as e:
-            print(f"提取sec_user_id失敗: {e}")
+            logger.warning(f"提取sec_user_id失敗: {e}")
             return None
     
-    def get_video_list_with_browser(self, user_url):
-        """使用瀏覽器獲取視頻列表"""
-        user_data_dir = None
+    def get_browser_page(self):
+        """取得共用瀏覽器的頁面，cookies 已在瀏覽器啟動時載入"""
+        return self.browser.get_page()
+    
+    def get_video_list_with_browser(self, user_url, incremental=False):
+        """使用瀏覽器獲取視頻列表，incremental 為 True 時滾動到上次同步的位置即停止"""
+        page = None
+        capture = None
         try:
-            print("啟動瀏覽器...")
-            co = ChromiumOptions()
-
-            # 改為 WSL2 上安裝的 Linux chromium
-            chrome_path = '/usr/bin/google-chrome'
-            co.set_browser_path(chrome_path)
-
-            # 必要參數
-            co.set_argument('--no-sandbox')
-            co.set_argument('--disable-dev-shm-usage')
-            co.set_argument('--disable-web-security')
-            co.set_argument('--disable-features=VizDisplayCompositor')
-            co.set_argument('--disable-extensions')
-            co.set_argument('--disable-plugins')
-            # 移除 --disable-images 以便能看到圖片
-            co.set_argument('--disable-setuid-sandbox')
-            co.set_argument('--remote-debugging-address=0.0.0.0')
-            co.set_argument('--headless=new')
-
-            # 設置用戶數據目錄避免衝突
-            user_data_dir = tempfile.mkdtemp()
-            co.set_user_data_path(user_data_dir)
-
-            # 自動選擇一個空閒端口並啟用 remote debugging
-            co.auto_port(9222)
-            co.set_argument(f'--remote-debugging-port={9222}')
-
-            print("正在啟動Chrome瀏覽器...")
-            page = ChromiumPage(addr_or_opts=co)
+            logger.info("啟動瀏覽器...")
+            page = self.get_browser_page()
             
-            # 載入 cookies 到瀏覽器
-            self.load_cookies_to_browser(page)
+            # 在打開頁面前開始監聽作品列表接口，用於判斷是否已滾動到底
+            page.listen.start(POST_API_PATTERN, res_type=POST_API_RES_TYPES)
             
             # 訪問用戶頁面
-            print("訪問用戶頁面...")
-            page.get(user_url)
-            time.sleep(5)  # 等待頁面加載
-            
-            # 開始監聽所有網絡請求
-            print("開始監聽網絡請求...")
-            page.listen.start()
+            logger.info("訪問用戶頁面...")
+            with self.metrics.stage('page_load', url=user_url):
+                page.get(user_url, timeout=self.timeouts['page_load'])
             
             # 檢查並關閉各種彈窗
-            self.close_popups(page)
+            with self.metrics.stage('close_popups'):
+                self.close_popups(page)
 
-            # 滾動頁面載入更多視頻
-            print("滾動頁面載入視頻...")
-            for i in range(3):
-                page.scroll.to_bottom()
-                time.sleep(2)
-                print(f"滾動 {i+1}/3...")
+            sec_user_id = self.extract_sec_user_id(user_url)
+            since_create_time = None
+            if incremental and sec_user_id:
+                _, since_create_time = self.manifest.get_last_seen(sec_user_id)
+            
+            # 滾動頁面直到作品列表接口返回 has_more 為 0、沒有新的視頻或到達上次同步的位置
+            logger.info("滾動頁面載入視頻...")
+            items = iter_post_feed(page, idle_timeout=self.timeouts['feed_idle'], since_create_time=since_create_time,
+                                   cache=self.feed_cache, sec_user_id=sec_user_id)
+            with self.metrics.stage('scroll_feed', sec_user_id=sec_user_id):
+                feed = list(items)
+            
+            page.listen.stop()
+            
+            # 懸停階段只記錄視頻資源的響應頭，不緩存其他請求和視頻內容
+            logger.info("開始監聽視頻請求...")
+            capture = MediaCapture(page)
+            capture.start()
 
             # 尋找視頻容器
             video_container_xpath = "/html/body/div[2]/div[1]/div[4]/div[2]/div/div/div/div[3]/div/div/div[2]/div/div[2]"
-            video_container = page.ele(f'xpath:{video_container_xpath}')
+            video_container = page.ele(f'xpath:{video_container_xpath}', timeout=self.timeouts['page_load'])
             
             if not video_container:
-                print("未找到視頻容器")
+                logger.warning("未找到視頻容器")
                 return None
 
             # 查找所有 li 元素（每個視頻項目）
             li_elements = video_container.eles('tag:li')
-            print(f"找到 {len(li_elements)} 個視頻項目")
+            logger.info(f"找到 {len(li_elements)} 個視頻項目")
+
+            # 懸停前先批量查詢下載清單，已下載的項目不再觸發視頻請求
+            li_aweme_ids = [self.get_li_aweme_id(li) for li in li_elements]
+            known = self.manifest.known_ids(li_aweme_ids)
+            if known:
+                logger.info(f"跳過 {len(known)} 個已下載的視頻")
 
             video_urls = []
             video_info_list = []
 
             # 遍歷每個 li 元素，在其子元素上鼠標懸停觸發視頻加載
             for i, li in enumerate(li_elements):
+                if li_aweme_ids[i] in known:
+                    continue
                 try:
-                    print(f"處理第 {i+1}/{len(li_elements)} 個視頻項目...")
+                    logger.debug(f"處理第 {i+1}/{len(li_elements)} 個視頻項目...")
                     
                     # 滾動到元素可見
                     li.scroll.to_see()
-                    time.sleep(1)
                     
                     # 關閉可能出現的彈窗
-                    self.close_popups(page)
+                    self.close_popups(page, timeout=0)
                     
                     # 清除之前的監聽記錄
-                    page.listen.clear()
+                    capture.clear()
                     
                     # 查找 li 內的所有子元素
                     child_elements = li.eles('*')  # 所有子元素
-                    print(f"在第 {i+1} 個項目中找到 {len(child_elements)} 個子元素")
+                    logger.debug(f"在第 {i+1} 個項目中找到 {len(child_elements)} 個子元素")
                     
-                    # 遍歷每個子元素進行懸停
-                    for j, child in enumerate(child_elements[:5]):  # 限制前5個子元素避免太多
-                        try:
-                            print(f"鼠標懸停在第 {i+1} 個項目的第 {j+1} 個子元素上...")
-                            child.hover()
-                            time.sleep(1)  # 縮短等待時間
-                            
-                        except Exception as child_error:
-                            print(f"懸停子元素失敗: {child_error}")
-                            continue
-                    
-                    # 等待一下讓請求觸發
-                    time.sleep(2)
-
-                    # 檢查最近的網絡請求（設置超時避免卡住）
-                    print(f"檢查第 {i+1} 個項目的網絡請求...")
-                    responses = []
-                    try:
-                        # 使用超時機制獲取響應
-                        start_time = time.time()
-                        timeout = 5  # 5秒超時
-                        
-                        while time.time() - start_time < timeout:
-                            current_responses = page.listen.steps()
-                            if current_responses:
-                                responses.extend(current_responses)
-                                break
-                            time.sleep(0.1)
-                        
-                    except Exception as listen_error:
-                        print(f"監聽請求時出錯: {listen_error}")
+                    with self.metrics.stage('hover_capture', aweme_id=li_aweme_ids[i]):
+                        # 遍歷每個子元素進行懸停，出現視頻請求後不再懸停其他子元素
                         responses = []
+                        found_request = False
+                        for j, child in enumerate(child_elements[:5]):  # 限制前5個子元素避免太多
+                            try:
+                                logger.debug(f"鼠標懸停在第 {i+1} 個項目的第 {j+1} 個子元素上...")
+                                child.hover()
+                            except Exception as child_error:
+                                logger.debug(f"懸停子元素失敗: {child_error}")
+                                continue
+                        
+                            try:
+                                if self.wait_video_response(capture, responses, self.timeouts['hover']):
+                                    found_request = True
+                                    break
+                            except Exception as listen_error:
+                                logger.warning(f"監聽請求時出錯: {listen_error}")
+                    
+                        # 懸停期間還沒有視頻請求時，再等待最多 media 秒
+                        if not found_request:
+                            logger.debug(f"檢查第 {i+1} 個項目的網絡請求...")
+                            try:
+                                self.wait_video_response(capture, responses, self.timeouts['media'])
+                            except Exception as listen_error:
+                                logger.warning(f"監聽請求時出錯: {listen_error}")
                     
                     # 處理找到的響應
                     found_video = False
-                    for response in responses:
+                    for video_url in responses:
                         try:
-                            if response.url and any(domain in response.url for domain in ['zjcdn.com', 'bytedance.com', 'douyin.com']):
-                                if ('video' in response.url and response.url.endswith(('.mp4', '.mov'))) or 'mime_type=video_mp4' in response.url:
-                                    if response.url not in video_urls:
-                                        video_urls.append(response.url)
-                                        print(f"✓ 找到視頻 URL: {response.url[:100]}...")
+                            if self.is_video_url(video_url):
+                                if video_url not in video_urls:
+                                    video_urls.append(video_url)
+                                    logger.debug(f"✓ 找到視頻 URL: {video_url[:100]}...")
                                         
-                                        # 嘗試獲取視頻標題
-                                        try:
-                                            # 查找 li 元素中的標題
-                                            title_elements = li.eles('tag:p') + li.eles('tag:span') + li.eles('[class*="title"]')
-                                            title = None
-                                            for title_elem in title_elements:
-                                                if title_elem.text and len(title_elem.text.strip()) > 0:
-                                                    title = title_elem.text.strip()
-                                                    break
+                                    # 嘗試獲取視頻標題
+                                    try:
+                                        # 查找 li 元素中的標題
+                                        title_elements = li.eles('tag:p', timeout=0) + li.eles('tag:span', timeout=0) + li.eles('[class*="title"]', timeout=0)
+                                        title = None
+                                        for title_elem in title_elements:
+                                            if title_elem.text and len(title_elem.text.strip()) > 0:
+                                                title = title_elem.text.strip()
+                                                break
                                             
-                                            if not title:
-                                                title = f"video_{i+1}"
+                                        if not title:
+                                            title = f"video_{i+1}"
                                             
-                                            # 清理文件名
-                                            safe_title = re.sub(r'[<>:"/\\|?*]', '_', title)[:50]
+                                        # 清理文件名
+                                        safe_title = re.sub(r'[<>:"/\\|?*]', '_', title)[:50]
                                             
-                                            video_info_list.append({
-                                                'url': response.url,
-                                                'title': safe_title,
-                                                'index': i+1
-                                            })
-                                            found_video = True
-                                            break
+                                        video_info_list.append({
+                                            'url': video_url,
+                                            'title': safe_title,
+                                            'index': i+1,
+                                            'aweme_id': li_aweme_ids[i]
+                                        })
+                                        found_video = True
+                                        break
                                             
-                                        except Exception as e:
-                                            print(f"獲取標題失敗: {e}")
-                                            video_info_list.append({
-                                                'url': response.url,
-                                                'title': f"video_{i+1}",
-                                                'index': i+1
-                                            })
-                                            found_video = True
-                                            break
+                                    except Exception as e:
+                                        logger.debug(f"獲取標題失敗: {e}")
+                                        video_info_list.append({
+                                            'url': video_url,
+                                            'title': f"video_{i+1}",
+                                            'index': i+1,
+                                            'aweme_id': li_aweme_ids[i]
+                                        })
+                                        found_video = True
+                                        break
                         except Exception as response_error:
-                            print(f"處理響應時出錯: {response_error}")
+                            logger.warning(f"處理響應時出錯: {response_error}")
                             continue
                     
                     if not found_video:
-                        print(f"第 {i+1} 個項目未找到視頻 URL")
+                        logger.debug(f"第 {i+1} 個項目未找到視頻 URL")
 
                     # 移動鼠標離開，避免干擾下一個
                     try:
                         page.actions.move_to((100, 100)).perform()
                     except:
                         pass
-                    time.sleep(1)
 
                 except Exception as e:
-                    print(f"處理第 {i+1} 個項目時出錯: {e}")
+                    logger.warning(f"處理第 {i+1} 個項目時出錯: {e}")
                     continue
 
-            print(f"總共找到 {len(video_urls)} 個視頻 URL")
+            logger.info(f"總共找到 {len(video_urls)} 個視頻 URL")
             
             if video_info_list:
                 # 直接下載視頻
                 self.download_videos_from_urls(video_info_list)
+                # 同步位置只推進到已下載的作品
+                advance_sync_state(self.manifest, sec_user_id, feed)
                 return True
             else:
-                print("未找到任何視頻 URL")
+                logger.warning("未找到任何視頻 URL")
                 return None
                     
         except Exception as e:
-            print(f"瀏覽器獲取數據失敗: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"瀏覽器獲取數據失敗: {e}")
             return None
         finally:
+            # 只停止監聽，瀏覽器留給下一次使用
+            if capture:
+                capture.stop()
             try:
-                page.quit()
+                page.listen.stop()
             except:
                 pass
-            # 清理臨時目錄
-            if user_data_dir:
-                try:
-                    shutil.rmtree(user_data_dir, ignore_errors=True)
-                except:
-                    pass
+    
+    def close(self):
+        """關閉共用的瀏覽器和下載清單，寫出最終的指標"""
+        self.browser.quit()
+        self.manifest.close()
+        self.metrics.close()
+        self.progress.close()
+    
+    def fetch_post_page(self, api_url):
+        """請求作品列表接口的一頁，返回解析後的 JSON，失敗時拋出 PostApiError 或 requests 的異常"""
+        # cookies 和請求頭已在 setup_session / load_cookies 中設置
+        with self.metrics.stage('api_fetch', url=api_url):
+            return fetch_post_page(self.session, api_url)
     
     def fetch_video_list(self, api_url):
-        """使用API獲取視頻列表"""
+        """使用API獲取一頁視頻列表，失敗時返回 None；按 sec_user_id 分頁獲取全部作品見 iter_post_api"""
+        logger.info("正在獲取視頻列表...")
         try:
-            print("正在獲取視頻列表...")
-            
-            # 添加必要的cookies和headers
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36',
-                'Accept': 'application/json, text/plain, */*',
-                'Accept-Language': 'zh-TW,zh;q=0.9,en;q=0.8',
-                'Accept-Encoding': 'gzip, deflate, br',
-                'Connection': 'keep-alive',
-                'Referer': 'https://www.douyin.com/',
-                'Sec-Fetch-Dest': 'empty',
-                'Sec-Fetch-Mode': 'cors',
-                'Sec-Fetch-Site': 'same-origin',
-                'sec-ch-ua': '"Not_A Brand";v="8", "Chromium";v="138", "Google Chrome";v="138"',
-                'sec-ch-ua-mobile': '?0',
-                'sec-ch-ua-platform': '"Windows"',
-            }
-            
-            response = self.session.get(api_url, headers=headers)
-            
-            print(f"HTTP狀態碼: {response.status_code}")
-            print(f"響應頭: {dict(response.headers)}")
-            print(f"響應內容前500字符: {response.text[:500]}")
-            
-            if response.status_code == 200:
-                if response.text.strip():
-                    try:
-                        data = response.json()
-                        if 'aweme_list' in data:
-                            print(f"成功獲取 {len(data['aweme_list'])} 個視頻")
-                            return data['aweme_list']
-                        else:
-                            print("響應中未找到aweme_list")
-                            print(f"可用的鍵: {list(data.keys()) if isinstance(data, dict) else 'Not a dict'}")
-                            return None
-                    except json.JSONDecodeError as e:
-                        print(f"JSON解析失敗: {e}")
-                        print(f"響應內容: {response.text}")
-                        return None
-                else:
-                    print("響應為空")
-                    return None
-            else:
-                print(f"請求失敗，狀態碼: {response.status_code}")
-                print(f"響應內容: {response.text}")
-                return None
-                
-        except Exception as e:
-            print(f"獲取視頻列表失敗: {e}")
-            import traceback
-            traceback.print_exc()
+            data = self.fetch_post_page(api_url)
+        except (PostApiError, requests.RequestException) as e:
+            logger.warning(f"獲取視頻列表失敗: {e}")
             return None
+        logger.info(f"成功獲取 {len(data['aweme_list'])} 個視頻")
+        return data['aweme_list']
+    
+    def get_host_semaphore(self, url):
+        """獲取對應主機的並行限制信號量"""
+        host = urlparse(url).netloc
+        with self._host_lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self._host_semaphores[host]
+    
+    def _run_job_with_host_limit(self, url, func, args):
+        """在主機並行限制內執行單個下載任務"""
+        with self.get_host_semaphore(url):
+            return func(*args)
+    
+    def run_download_jobs(self, jobs):
+        """執行下載任務列表，返回成功數量
+        
+        jobs 為 (url, func, args) 的列表，func(*args) 返回是否成功。
+        max_workers <= 1 時逐個下載。請求間隔由 self.rate_limiter 控制，不再固定延遲。
+        """
+        success_count = 0
+        
+        if self.max_workers <= 1:
+            for url, func, args in jobs:
+                if func(*args):
+                    success_count += 1
+            return success_count
+        
+        logger.info(f"使用 {self.max_workers} 個線程並行下載 (每個主機最多 {self.per_host_limit} 個連接)")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._run_job_with_host_limit, url, func, args) for url, func, args in jobs]
+            for future in as_completed(futures):
+                try:
+                    if future.result():
+                        success_count += 1
+                except Exception as e:
+                    logger.error(f"✗ 下載任務出錯: {e}")
+        
+        return success_count
+    
+    def download_from_video_info(self, video_info, position, total):
+        """下載 download_videos_from_urls 中的單個視頻，經過 download_video 按指數退避重試，成功後記錄到下載清單"""
+        filename = f"{video_info['index']:03d}_{video_info['title']}.mp4"
+        logger.debug(f"第 {position}/{total} 個視頻: {filename}")
+        try:
+            if not self.download_video(video_info['url'], filename):
+                self.manifest.record_failure(video_info.get('aweme_id'))
+                return False
+        except URLExpiredError:
+            if video_info.get('aweme_id'):
+                logger.warning(f"稍後重新獲取鏈接: {filename}")
+                self.mark_expired(video_info['aweme_id'], filename=filename)
+            return False
+        if video_info.get('aweme_id'):
+            self.manifest.record(video_info['aweme_id'], os.path.join(self.download_folder, filename))
+        return True
     
     def download_videos_from_urls(self, video_info_list):
         """從視頻 URL 列表下載視頻"""
-        print(f"開始下載 {len(video_info_list)} 個視頻...")
+        logger.info(f"開始下載 {len(video_info_list)} 個視頻...")
         
-        success_count = 0
+        # 下載前再查詢一次清單，跳過其他運行中已下載的視頻
+        known = self.manifest.known_ids(info.get('aweme_id') for info in video_info_list)
+        if known:
+            logger.info(f"跳過 {len(known)} 個已下載的視頻")
+        
+        total = len(video_info_list)
+        jobs = []
         for i, video_info in enumerate(video_info_list):
-            try:
-                video_url = video_info['url']
-                title = video_info['title']
-                index = video_info['index']
-                
-                # 構建文件名
-                filename = f"{index:03d}_{title}.mp4"
-                
-                print(f"正在下載第 {i+1}/{len(video_info_list)} 個視頻: {filename}")
-                
-                # 設置下載用的請求頭
-                headers = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36',
-                    'Referer': 'https://www.douyin.com/',
-                    'Accept': '*/*',
-                    'Accept-Language': 'zh-TW,zh;q=0.9,en;q=0.8',
-                    'Accept-Encoding': 'gzip, deflate, br',
-                    'Connection': 'keep-alive',
-                }
-                
-                # 使用 session 下載視頻
-                response = self.session.get(video_url, headers=headers, stream=True)
-                
-                if response.status_code == 200:
-                    filepath = os.path.join(self.download_folder, filename)
-                    
-                    # 獲取文件大小
-                    total_size = int(response.headers.get('content-length', 0))
-                    downloaded_size = 0
-                    
-                    with open(filepath, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
-                                downloaded_size += len(chunk)
-                                
-                                # 顯示下載進度
-                                if total_size > 0:
-                                    progress = (downloaded_size / total_size) * 100
-                                    print(f"\r下載進度: {progress:.1f}%", end='', flush=True)
-                    
-                    print(f"\n✓ 下載完成: {filename}")
-                    success_count += 1
-                else:
-                    print(f"✗ 下載失敗: {filename}, 狀態碼: {response.status_code}")
-                    
-            except Exception as e:
-                print(f"✗ 下載失敗: {filename}, 錯誤: {e}")
+            if video_info.get('aweme_id') in known:
                 continue
-                
-            # 添加延遲避免請求過快
-            time.sleep(2)
+            jobs.append((video_info.get('url', ''), self.download_from_video_info, (video_info, i+1, total)))
+        
+        start_time = time.time()
+        success_count = self.run_download_jobs(jobs)
+        success_count += len(self.retry_expired_downloads())
         
-        print(f"\n下載完成！成功: {success_count}/{len(video_info_list)}")
+        logger.info(f"下載完成！成功: {success_count}/{len(video_info_list)}，耗時 {time.time() - start_time:.1f} 秒")
     
-    def download_video(self, video_url, filename):
-        """下載單個視頻"""
+    def download_video(self, video_urls, filename):
+        """下載視頻，video_urls 為同一個視頻的鏡像地址列表（也可以是單個地址）
+
+        按 self.mirrors 的排序嘗試各個鏡像，出錯或速度過慢時切換。地址過期時拋出 URLExpiredError。
+        """
+        if isinstance(video_urls, str):
+            video_urls = [video_urls]
+        retries = []
+        start = time.perf_counter()
         try:
-            print(f"正在下載: {filename}")
-            
-            # 設置下載用的請求頭
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36',
-                'Referer': 'https://www.douyin.com/',
-            }
-            
-            response = self.session.get(video_url, headers=headers, stream=True)
-            
-            if response.status_code == 200:
-                filepath = os.path.join(self.download_folder, filename)
-                
-                with open(filepath, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-                
-                print(f"✓ 下載完成: {filename}")
-                return True
-            else:
-                print(f"✗ 下載失敗: {filename}, 狀態碼: {response.status_code}")
-                return False
-                
+            logger.info(f"正在下載: {filename}")
+            filepath = os.path.join(self.download_folder, filename)
+            size = download_from_mirrors(self.mirrors, video_urls,
+                                         lambda url, progress: fetch_video(self.session, url, filepath, self.segments, progress),
+                                         on_retry=lambda url, e: retries.append(e),
+                                         progress=self.progress.callback(filename))
+            self.metrics.record_download(filename, size, time.perf_counter() - start, len(retries))
+            downloaded, rate = self.progress.finish(filename)
+            logger.info(f"✓ 下載完成: {filename} ({format_bytes(downloaded)}, {format_bytes(rate)}/s)")
+            return True
+        
+        except requests.HTTPError as e:
+            if is_url_expired(e):
+                self.metrics.record_download(filename, 0, time.perf_counter() - start, len(retries), 'expired', e)
+                logger.warning(f"✗ 鏈接已過期: {filename}, 狀態碼: {e.response.status_code}")
+                raise URLExpiredError(video_urls[0]) from e
+            self.metrics.record_download(filename, 0, time.perf_counter() - start, len(retries), 'failed', e)
+            logger.error(f"✗ 下載失敗: {filename}, 錯誤: {e}")
+            return False
         except Exception as e:
-            print(f"✗ 下載失敗: {filename}, 錯誤: {e}")
-            return False    
+            self.metrics.record_download(filename, 0, time.perf_counter() - start, len(retries), 'failed', e)
+            logger.error(f"✗ 下載失敗: {filename}, 錯誤: {e}")
+            return False
+        finally:
+            self.progress.finish(filename)
     
-    def extract_video_info(self, aweme_item):
+    def parse_bit_rate(self, bit_rate_item):
+        """將 bit_rate 數組中的一項整理為清晰度信息"""
+        play_addr = bit_rate_item.get('play_addr', {})
+        width = play_addr.get('width', 0) or 0
+        height = play_addr.get('height', 0) or 0
+        return {
+            'gear_name': bit_rate_item.get('gear_name', ''),
+            'bit_rate': bit_rate_item.get('bit_rate', 0) or 0,
+            'width': width,
+            'height': height,
+            # 豎屏視頻的寬比高小，用短邊表示清晰度
+            'resolution': min(width, height) if width and height else max(width, height),
+            'is_h265': bool(bit_rate_item.get('is_h265') or bit_rate_item.get('is_bytevc1')),
+            'data_size': play_addr.get('data_size', 0) or 0,
+            'urls': list(play_addr.get('url_list', [])),
+        }
+    
+    def select_variant(self, variants, policy):
+        """按策略從清晰度列表中選擇一個，沒有可用的返回 None"""
+        variants = [v for v in variants if v['urls']]
+        if not variants:
+            return None
+        
+        if policy == 'smallest':
+            # 沒有 data_size 時用碼率估算
+            return min(variants, key=lambda v: (v['data_size'] or float('inf'), v['bit_rate']))
+        
+        if policy == '720p':
+            capped = [v for v in variants if v['resolution'] and v['resolution'] <= 720]
+            if not capped:
+                logger.info("沒有 720p 以下的版本，使用最小的版本")
+                return self.select_variant(variants, 'smallest')
+            return max(capped, key=lambda v: (v['bit_rate'], v['resolution']))
+        
+        if policy == 'h264':
+            h264 = [v for v in variants if not v['is_h265']]
+            return max(h264 or variants, key=lambda v: (v['bit_rate'], v['resolution']))
+        
+        # highest
+        return max(variants, key=lambda v: (v['bit_rate'], v['resolution']))
+    
+    def extract_video_info(self, aweme_item, policy=None):
         """提取視頻信息"""
         try:
+            policy = policy or self.variant_policy
+            
             # 獲取視頻描述
             desc = aweme_item.get('desc', '無標題')
             
@@ -535,16 +652,24 @@ class DouyinVideoDownloader:
             
             # 獲取視頻URL
             video_urls = []
+            variant = None
             video_info = aweme_item.get('video', {})
+            bit_rate = video_info.get('bit_rate', []) or []
+            
+            # 按策略從 bit_rate 的所有版本中選擇，不需要額外的網絡請求
+            if policy != 'play_addr' and bit_rate:
+                variant = self.select_variant([self.parse_bit_rate(item) for item in bit_rate], policy)
+                if variant:
+                    video_urls.extend(variant['urls'])
             
             # 嘗試獲取play_addr中的url_list
-            play_addr = video_info.get('play_addr', {})
-            if 'url_list' in play_addr:
-                video_urls.extend(play_addr['url_list'])
+            if not video_urls:
+                play_addr = video_info.get('play_addr', {})
+                if 'url_list' in play_addr:
+                    video_urls.extend(play_addr['url_list'])
             
             # 如果沒有找到，嘗試其他位置
             if not video_urls:
-                bit_rate = video_info.get('bit_rate', [])
                 if bit_rate:
                     play_addr = bit_rate[0].get('play_addr', {})
                     if 'url_list' in play_addr:
@@ -553,63 +678,359 @@ class DouyinVideoDownloader:
             return {
                 'id': aweme_id,
                 'desc': safe_desc,
-                'urls': video_urls
+                'urls': video_urls,
+                'variant': variant
             }
             
         except Exception as e:
-            print(f"提取視頻信息失敗: {e}")
+            logger.warning(f"提取視頻信息失敗: {e}")
             return None
     
     def process_video_list(self, aweme_list):
-        """處理視頻列表並下載"""
+        """處理視頻列表並下載，完成後推進每個作者的同步位置（aweme_list 應為完整發現的作品列表）"""
         if not aweme_list:
-            print("沒有找到視頻列表")
+            logger.warning("沒有找到視頻列表")
             return
         
-        print(f"開始處理 {len(aweme_list)} 個視頻...")
+        logger.info(f"開始處理 {len(aweme_list)} 個視頻...")
         
-        success_count = 0
+        # 發出任何請求前先批量查詢下載清單
+        known = self.manifest.known_ids(item.get('aweme_id') for item in aweme_list)
+        
+        jobs = []
         for i, aweme_item in enumerate(aweme_list):
+            if str(aweme_item.get('aweme_id')) in known:
+                continue
+            
             video_info = self.extract_video_info(aweme_item)
             
             if video_info and video_info['urls']:
-                # 使用第一個可用的URL
+                # 第一個地址用於主機並行限制，下載時再從所有鏡像中選擇
                 video_url = video_info['urls'][0]
                 filename = f"{video_info['id']}_{video_info['desc']}.mp4"
-                
-                if self.download_video(video_url, filename):
-                    success_count += 1
-                
-                # 添加延遲避免請求過快
-                time.sleep(1)
+                sec_user_id = (aweme_item.get('author') or {}).get('sec_uid')
+                jobs.append((video_url, self.download_aweme, (video_info, filename, sec_user_id)))
             else:
-                print(f"✗ 無法提取視頻信息: {i+1}")
+                logger.warning(f"✗ 無法提取視頻信息: {i+1}")
+        
+        start_time = time.time()
+        success_count = self.run_download_jobs(jobs)
+        success_count += len(self.retry_expired_downloads())
         
-        print(f"\n下載完成！成功: {success_count}/{len(aweme_list)}")
+        logger.info(f"下載完成！成功: {success_count}/{len(aweme_list)}，跳過已下載: {len(known)}，耗時 {time.time() - start_time:.1f} 秒")
+        
+        # 按作者推進同步位置，只推進到已下載的作品
+        feeds = {}
+        for aweme_item in aweme_list:
+            feeds.setdefault((aweme_item.get('author') or {}).get('sec_uid'), []).append(aweme_item)
+        for sec_user_id, feed in feeds.items():
+            advance_sync_state(self.manifest, sec_user_id, feed)
     
-    def run(self, user_url, api_url=None):
-        """主要運行函數"""
-        print("=== 抖音視頻下載器 ===")
-        print(f"用戶頁面: {user_url}")
+    def download_aweme(self, video_info, filename, sec_user_id=None):
+        """下載 extract_video_info 得到的視頻，成功後記錄到下載清單
         
-        # 由於API URL可能已過期，直接使用瀏覽器獲取數據
-        print("使用瀏覽器獲取數據...")
-        aweme_list = self.get_video_list_with_browser(user_url)
+        地址已過期時記錄下來，由 retry_expired_downloads 統一重新獲取地址後重試。
+        """
+        try:
+            if not self.download_video(video_info['urls'], filename):
+                self.manifest.record_failure(video_info['id'], sec_user_id)
+                return False
+        except URLExpiredError:
+            self.mark_expired(video_info['id'], sec_user_id, filename)
+            return False
+        variant = video_info['variant']['gear_name'] if video_info.get('variant') else self.variant_policy
+        self.manifest.record(video_info['id'], os.path.join(self.download_folder, filename),
+                             sec_user_id=sec_user_id, variant=variant)
+        return True
+    
+    def mark_expired(self, aweme_id, sec_user_id=None, filename=None):
+        """記錄地址已過期的視頻，filename 為原來的文件名，重試時沿用，同一次運行中的命名保持一致"""
+        with self._expired_lock:
+            self._expired[str(aweme_id)] = (sec_user_id, filename)
+    
+    def retry_expired_downloads(self):
+        """一次性重新獲取所有地址已過期視頻的最新地址並重試一次，返回重試成功的 aweme_id 集合
         
-        if aweme_list:
-            self.process_video_list(aweme_list)
-        else:
-            print("無法獲取視頻數據")
+        只打開一個標籤頁，逐個訪問這些視頻的頁面並從作品詳情接口拿到新簽名的地址。
+        """
+        with self._expired_lock:
+            expired, self._expired = self._expired, {}
+        if not expired:
+            return set()
+        
+        logger.warning(f"{len(expired)} 個視頻的鏈接已過期，重新獲取鏈接...")
+        tab = None
+        try:
+            self.get_browser_page()
+            tab = self.browser.new_tab(blocked_resources=DISCOVERY_BLOCKED_RESOURCES)
+            with self.metrics.stage('refresh_urls', count=len(expired)):
+                details = resolve_aweme_details(tab, list(expired), timeout=self.timeouts['media'],
+                                                page_load_timeout=self.timeouts['page_load'])
+        except Exception as e:
+            logger.warning(f"重新獲取鏈接失敗: {e}")
+            return set()
+        finally:
+            if tab is not None:
+                try:
+                    tab.close()
+                except Exception:
+                    pass
+        
+        jobs = []
+        for aweme_id, (sec_user_id, filename) in expired.items():
+            video_info = self.extract_video_info(details[aweme_id]) if aweme_id in details else None
+            if not video_info or not video_info['urls']:
+                logger.warning(f"✗ 無法重新獲取鏈接: {aweme_id}")
+                self.manifest.record_failure(aweme_id, sec_user_id)
+                continue
+            video_url = video_info['urls'][0]
+            filename = filename or f"{video_info['id']}_{video_info['desc']}.mp4"
+            jobs.append((video_url, self.download_aweme, (video_info, filename, sec_user_id)))
+        
+        self.run_download_jobs(jobs)
+        
+        # 只重試一次，再次過期的不再處理
+        with self._expired_lock:
+            self._expired = {}
+        recovered = self.manifest.known_ids(expired)
+        logger.info(f"重新獲取鏈接後成功下載 {len(recovered)}/{len(expired)} 個視頻")
+        return recovered
+    
+    def read_user_file(self, user_file):
+        """讀取用戶列表文件，每行一個用戶主頁 URL，忽略空行和 # 開頭的註釋"""
+        with open(user_file, 'r', encoding='utf-8') as f:
+            lines = [line.strip() for line in f]
+        return [line for line in lines if line and not line.startswith('#')]
+    
+    def iter_user_aweme(self, user_url, incremental=False):
+        """逐個 yield 用戶的 aweme 項目
+        
+        依次嘗試：完整且未過期的緩存、直接分頁請求作品列表接口、在瀏覽器中滾動用戶主頁。
+        不更新同步位置，下載完成後由調用方用 advance_sync_state 推進。
+        """
+        sec_user_id = self.extract_sec_user_id(user_url)
+        since_create_time = None
+        if incremental and sec_user_id:
+            _, since_create_time = self.manifest.get_last_seen(sec_user_id)
+        
+        cached = self.feed_cache.load_feed(sec_user_id, since_create_time) if sec_user_id else None
+        if cached is not None:
+            logger.info(f"使用緩存的作品列表: {len(cached)} 個視頻")
+            yield from cached
+            return
+        
+        yield from self.iter_feed_with_fallback(user_url, sec_user_id, since_create_time)
+    
+    def iter_feed_with_fallback(self, user_url, sec_user_id, since_create_time=None):
+        """先用 HTTP 分頁請求作品列表接口，接口不可用時改用瀏覽器，已 yield 的項目不會重複"""
+        seen_ids = set()
+        if sec_user_id:
+            try:
+                with self.metrics.stage('api_feed', sec_user_id=sec_user_id):
+                    for item in iter_post_api(self.fetch_post_page, sec_user_id, since_create_time, cache=self.feed_cache):
+                        seen_ids.add(item.get('aweme_id'))
+                        yield item
+                return
+            except (PostApiError, requests.RequestException) as e:
+                logger.warning(f"作品列表接口不可用，改用瀏覽器獲取: {e}")
+        
+        items = self.iter_feed_with_browser(user_url, sec_user_id, since_create_time)
+        yield from (item for item in items if item.get('aweme_id') not in seen_ids)
+    
+    def iter_feed_with_browser(self, user_url, sec_user_id, since_create_time=None):
+        """在共用瀏覽器的新標籤頁中打開用戶主頁，邊滾動邊 yield aweme 項目，結束後關閉標籤頁"""
+        self.get_browser_page()
+        tab = self.browser.new_tab(blocked_resources=DISCOVERY_BLOCKED_RESOURCES)
+        try:
+            tab.listen.start(POST_API_PATTERN, res_type=POST_API_RES_TYPES)
+            with self.metrics.stage('page_load', url=user_url):
+                tab.get(user_url, timeout=self.timeouts['page_load'])
+            with self.metrics.stage('close_popups'):
+                self.close_popups(tab)
+            items = iter_post_feed(tab, idle_timeout=self.timeouts['feed_idle'], since_create_time=since_create_time,
+                                   cache=self.feed_cache, sec_user_id=sec_user_id)
+            # 批量模式下多個用戶輪流讀取，包含等待其他用戶的時間
+            with self.metrics.stage('scroll_feed', sec_user_id=sec_user_id):
+                yield from items
+        finally:
+            try:
+                tab.listen.stop()
+                tab.close()
+            except Exception:
+                pass
+    
+    def run_batch(self, user_file, report_file=None, incremental=False, max_open_tabs=3, items_per_turn=20):
+        """批量處理用戶列表文件中的所有用戶
+        
+        所有用戶共用一個瀏覽器和下載線程池。發現階段每個用戶一個標籤頁（最多同時處理 max_open_tabs 個用戶），
+        每輪每個用戶最多取 items_per_turn 個視頻；下載任務按用戶輪流執行，大賬號不會餓死其他用戶。
+        結束後把每個用戶的結果寫入 report_file（默認在下載資料夾中的 batch_report.json）。
+        """
+        user_urls = self.read_user_file(user_file)
+        logger.info(f"=== 批量下載 {len(user_urls)} 個用戶 ===")
+        
+        reports = [{
+            'user_url': url,
+            'sec_user_id': self.extract_sec_user_id(url),
+            'discovered': 0,
+            'skipped': 0,
+            'success': 0,
+            'failed': 0,
+            'error': None,
+        } for url in user_urls]
+        report_lock = threading.Lock()
+        job_queue = FairJobQueue()
+        # aweme_id -> 用戶序號，重試過期鏈接後用於更新報告
+        owners = {}
+        # 每個用戶發現的作品和完整發現完畢的用戶序號，下載結束後用於推進同步位置
+        feeds = [[] for _ in user_urls]
+        completed = set()
+        start_time = time.time()
+        
+        def download_worker():
+            while True:
+                entry = job_queue.get()
+                if entry is None:
+                    return
+                index, (video_url, func, args) = entry
+                try:
+                    ok = self._run_job_with_host_limit(video_url, func, args)
+                except Exception as e:
+                    logger.error(f"✗ 下載任務出錯: {e}")
+                    ok = False
+                with report_lock:
+                    reports[index]['success' if ok else 'failed'] += 1
+        
+        workers = [threading.Thread(target=download_worker, daemon=True) for _ in range(max(self.max_workers, 1))]
+        for worker in workers:
+            worker.start()
+        
+        def queue_items(index, items):
+            # 批量查詢下載清單後把新視頻加入該用戶的下載隊列
+            known = self.manifest.known_ids(item.get('aweme_id') for item in items)
+            feeds[index].extend(items)
+            reports[index]['discovered'] += len(items)
+            reports[index]['skipped'] += len(known)
+            for item in items:
+                if str(item.get('aweme_id')) in known:
+                    continue
+                video_info = self.extract_video_info(item)
+                if not video_info or not video_info['urls']:
+                    with report_lock:
+                        reports[index]['failed'] += 1
+                    continue
+                video_url = video_info['urls'][0]
+                filename = f"{video_info['id']}_{video_info['desc']}.mp4"
+                sec_user_id = (item.get('author') or {}).get('sec_uid') or reports[index]['sec_user_id']
+                owners[str(video_info['id'])] = index
+                job_queue.put(index, (video_url, self.download_aweme, (video_info, filename, sec_user_id)))
+        
+        try:
+            pending = deque(range(len(user_urls)))
+            active = []
+            while pending or active:
+                # 補充打開新的用戶標籤頁
+                while pending and len(active) < max_open_tabs:
+                    index = pending.popleft()
+                    logger.info(f"開始發現用戶 {index+1}/{len(user_urls)}: {user_urls[index]}")
+                    active.append((index, self.iter_user_aweme(user_urls[index], incremental=incremental)))
+                
+                # 每個用戶輪流取一批視頻
+                for entry in list(active):
+                    index, items = entry
+                    batch = []
+                    finished = False
+                    try:
+                        while len(batch) < items_per_turn:
+                            batch.append(next(items))
+                    except StopIteration:
+                        finished = True
+                    except Exception as e:
+                        logger.warning(f"發現用戶視頻失敗: {user_urls[index]}, 錯誤: {e}")
+                        reports[index]['error'] = str(e)
+                        finished = True
+                    if batch:
+                        queue_items(index, batch)
+                    if finished:
+                        active.remove(entry)
+                        if reports[index]['error'] is None:
+                            completed.add(index)
+                        logger.info(f"用戶 {index+1} 發現完畢: {reports[index]['discovered']} 個視頻")
+        
+        except Exception as e:
+            logger.exception(f"批量處理失敗: {e}")
+        finally:
+            job_queue.close()
+            for worker in workers:
+                worker.join()
+        
+        # 排隊太久而過期的鏈接統一重新獲取後重試
+        for aweme_id in self.retry_expired_downloads():
+            index = owners.get(aweme_id)
+            if index is not None:
+                reports[index]['success'] += 1
+                reports[index]['failed'] -= 1
+        
+        # 發現完整的用戶才推進同步位置，且只推進到已下載的作品
+        for index in completed:
+            advance_sync_state(self.manifest, reports[index]['sec_user_id'], feeds[index])
+        
+        report_file = report_file or os.path.join(self.download_folder, 'batch_report.json')
+        with open(report_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                'started_at': start_time,
+                'elapsed': time.time() - start_time,
+                'users': reports,
+            }, f, ensure_ascii=False, indent=2)
+        
+        logger.info(f"=== 批量下載完成，耗時 {time.time() - start_time:.1f} 秒 ===")
+        for report in reports:
+            logger.info(f"{report['sec_user_id'] or report['user_url']}: 發現 {report['discovered']}，"
+                  f"跳過 {report['skipped']}，成功 {report['success']}，失敗 {report['failed']}"
+                  + (f"，錯誤: {report['error']}" if report['error'] else ''))
+        logger.info(f"報告已保存到: {report_file}")
+        self.metrics.write_prometheus()
+        return reports
+    
+    def run(self, user_url, api_url=None, incremental=False):
+        """主要運行函數，incremental 為 True 時只處理上次同步之後的新作品"""
+        logger.info("=== 抖音視頻下載器 ===")
+        logger.info(f"用戶頁面: {user_url}")
+        
+        # 由於API URL可能已過期，直接使用瀏覽器獲取數據
+        logger.info("使用瀏覽器獲取數據...")
+        with self.metrics.stage('run', user_url=user_url):
+            # 懸停流程找到視頻後已直接下載並返回 True，只有返回作品列表時才需要再下載
+            result = self.get_video_list_with_browser(user_url, incremental=incremental)
+
+            if isinstance(result, list):
+                self.process_video_list(result)
+            elif not result:
+                logger.warning("無法獲取視頻數據")
+        self.metrics.write_prometheus()
 
 def main():
+    setup_logging()
+    # 傳入用戶列表文件時批量下載
+    if len(sys.argv) > 1:
+        downloader = DouyinVideoDownloader()
+        try:
+            downloader.run_batch(sys.argv[1])
+        finally:
+            downloader.close()
+        return
+    
     # 用戶URL
     user_url = "https://www.douyin.com/user/MS4wLjABAAAAhGTvofJSpb_dRb51A_xGF5siEeiHB2ryBSRZ9V0NtM7C-UgZ9ACJLTO7HwEGnFSE?from_tab_name=main"
     
     # 創建下載器實例
     downloader = DouyinVideoDownloader()
     
-    # 運行下載器
-    downloader.run(user_url)
+    try:
+        # 運行下載器
+        downloader.run(user_url)
+    finally:
+        downloader.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file